@@ -1,9 +1,22 @@
+import json
+import os
 import sys
-import json 
+from itertools import chain, zip_longest
 import numpy as np
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import *
+
 TOL = 1e-9
-SCALE = 1
+# Fixed-point scale for maximum_flow, None picks the smallest power of 10 that
+# makes every rate integral within TOL
+SCALE = None
+MAX_SCALE = 10**9
+# maximum_flow silently truncates capacities to int32
+MAX_CAPACITY = np.iinfo(np.int32).max
+# Initial rows of the edge arrays of scan_ndjson, and bytes of lines parsed at once
+EDGE_CHUNK = 4096
+NDJSON_CHUNK_BYTES = 2**20
 
 def scan_input():
     try:
@@ -12,6 +25,55 @@ def scan_input():
         print("Invalid Input")
         exit()
 
+def get_edge_row(edge):
+    if isinstance(edge, dict):
+        return edge["from"], edge["to"], edge["lo"], edge["hi"], edge.get("cost", 0)
+    return edge
+
+def scan_ndjson(infile):
+    # First line: the request without "edges" (optionally with "edge_count"), then
+    # one edge per line as [from, to, lo, hi], [from, to, lo, hi, cost] or an edge
+    # object. Lines are parsed a chunk at a time and copied column-wise into NumPy
+    # arrays over interned node names, grown by doubling when needed.
+    try:
+        data = json.loads(infile.readline())
+        size = max(data.pop("edge_count", 0), EDGE_CHUNK)
+        names = {}
+        ends = np.empty((size, 2), dtype=np.int64)
+        rates = np.empty((size, 3))
+        m = 0
+        for lines in iter(lambda: infile.readlines(NDJSON_CHUNK_BYTES), []):
+            text = ",".join(line for line in lines if not line.isspace())
+            edges = json.loads("[" + text + "]")
+            if "{" in text:
+                edges = [get_edge_row(edge) for edge in edges]
+            if not edges:
+                continue
+            if not set(map(len, edges)) <= {4, 5}:
+                raise ValueError("edge rows need 4 or 5 fields")
+            frm, to, *rates_in = zip_longest(*edges, fillvalue=0)
+            k = len(frm)
+            # New names get ids in order of first appearance, as in get_edge_table
+            new = [name for name in dict.fromkeys(chain.from_iterable(zip(frm, to))) if name not in names]
+            names.update(zip(new, range(len(names), len(names) + len(new))))
+            if m + k > len(ends):
+                size = max(2*len(ends), m + k)
+                ends = np.resize(ends, (size, 2))
+                rates = np.resize(rates, (size, 3))
+            ends[m:m+k, 0] = np.fromiter(map(names.__getitem__, frm), np.int64, k)
+            ends[m:m+k, 1] = np.fromiter(map(names.__getitem__, to), np.int64, k)
+            rates[m:m+k, 2] = 0
+            rates[m:m+k, :len(rates_in)] = np.array(rates_in, dtype=float).T
+            m += k
+    except Exception as e:
+        print("Invalid Input")
+        exit()
+    data["edge_table"] = {
+        "names": list(names), "from": ends[:m, 0], "to": ends[:m, 1],
+        "lo": rates[:m, 0], "hi": rates[:m, 1], "cost": rates[:m, 2],
+    }
+    return data
+
 def clean_json(obj):
     if isinstance(obj, dict):
         return {key: clean_json(value) for key, value in obj.items()}
@@ -30,29 +92,43 @@ def clean_json(obj):
         
     return obj
 
-def print_json(obj):
-    print(json.dumps(clean_json(obj), indent=4, sort_keys=True))
+def format_json(obj, indent=4):
+    return json.dumps(clean_json(obj), indent=indent, sort_keys=True)
 
-def make_edge(u, v, cap):
-    return {"from": u, "to": v, "cap": cap}
+def write_json(obj, out, indent=4):
+    # Same text as print(format_json(obj), file=out), streamed
+    out.writelines(iter_json(obj, indent, sort_keys=True))
+    out.write("\n")
 
-def make_tight_edge(u, v):
-    return {"from": u, "to": v}
+def is_integral(values, scale):
+    scaled = values * scale
+    return np.all(np.abs(scaled - np.rint(scaled)) <= TOL * scale)
 
-def in_node(node):
-    return node + "_in"
+def get_scale(values, scale=None):
+    # An explicit scale rounds every rate to the nearest multiple of 1/scale
+    if scale is not None:
+        return scale
+    values = np.asarray(values, dtype=float)
+    scale = 1
+    while scale < MAX_SCALE and not is_integral(values, scale):
+        scale *= 10
+    return scale
 
-def out_node(node):
-    return node + "_out"
+def capacity_error(scale):
+    # Lowering the scale only helps if it is above 1
+    if scale == 1:
+        return OverflowError("Rates do not fit the int32 capacities of maximum_flow")
+    return OverflowError(f"Rates scaled by {scale} do not fit the int32 capacities of maximum_flow, pass a smaller --scale")
 
-def get_in_node(node, upd_nodes):
-    return in_node(node) if in_node(node) in upd_nodes else node
+def to_fixed(values, scale):
+    # Checked before the cast, which would wrap huge values around to INT64_MIN
+    fixed = np.rint(np.asarray(values, dtype=float) * scale)
+    if not np.all(np.abs(fixed) <= MAX_CAPACITY):
+        raise capacity_error(scale)
+    return fixed.astype(np.int64)
 
-def get_out_node(node, upd_nodes):
-    return out_node(node) if out_node(node) in upd_nodes else node
+def from_fixed(value, scale):
+    return value if scale == 1 else value / scale
 
-def get_node(node):
-    if len(node)>3 and (node[-3:] == "_in" or node[-4:] == "_out"):
-        return node[:-3] if node[-3:] == "_in" else node[:-4]
-    else:
-        return node
+def make_tight_edge(u, v):
+    return {"from": u, "to": v}
@@ -1,184 +1,749 @@
 from helpers import *
+import argparse
+from types import SimpleNamespace
 from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import maximum_flow, breadth_first_order
+from scipy.sparse.csgraph import maximum_flow, breadth_first_order, connected_components
+from scipy.optimize import linprog
 
-S = "SOURCE"
-T = "SINK"
+MODES = ("feasibility", "max_flow", "min_cost")
+CERTIFICATES = ("reachable", "all_cuts")
+# BFS rounds a BeltSession repair may take before solving from scratch
+REPAIR_ROUNDS = 32
+# Part of every result cache key, bump it whenever the output for a request changes
+CACHE_VERSION = 2
+
+def check_capacity(caps, total_demand, scale):
+    if max(caps.max(initial=0), total_demand) > MAX_CAPACITY:
+        raise capacity_error(scale)
+
+def get_flow_bound(data, lo_total, costs):
+    # Some feasible, maximum or (without negative costs) cheapest flow carries at
+    # most this on any edge or node: paths move at most the larger of the supply
+    # and demand totals, and cycles are only needed to meet the lower bounds
+    if np.any(costs < 0):
+        return np.inf
+    return max(sum(data["sources"].values()), sum(data.get("sinks", {}).values())) + lo_total
+
+def get_sink_demands(data, supplies, scale):
+    # Fixed-point demand of every sink: "sinks" maps nodes to their demand and
+    # "sink" takes whatever those demands leave of the supplies
+    demands = {}
+    for sink, demand in zip(data.get("sinks", {}), to_fixed(list(data.get("sinks", {}).values()), scale)):
+        demands[sink] = int(demand)
+    if "sink" in data:
+        rest = max(int(supplies.sum()) - sum(demands.values()), 0)
+        demands[data["sink"]] = demands.get(data["sink"], 0) + rest
+    return demands
+
+def get_edge_table(data):
+    # Edges as arrays over interned node names: as loaded by scan_ndjson, or built
+    # from the edge dicts of a JSON request
+    if "edge_table" in data:
+        return data["edge_table"]
+    names = {}
+    ends = np.array([names.setdefault(u, len(names)) for edge in data["edges"] for u in (edge["from"], edge["to"])], dtype=np.int64).reshape(-1, 2)
+    return {
+        "names": list(names), "from": ends[:, 0], "to": ends[:, 1],
+        "lo": np.array([edge["lo"] for edge in data["edges"]], dtype=float),
+        "hi": np.array([edge["hi"] for edge in data["edges"]], dtype=float),
+        "cost": np.array([edge.get("cost", 0) for edge in data["edges"]], dtype=float),
+    }
+
+def transform_graph(data, scale=SCALE, terminals=True):
+    # With terminals=False the supplies and demands are not balances but the caps
+    # of arcs SRC -> source and sink -> SNK, with a return arc SNK -> SRC, so only
+    # the lower bounds have to be met by the S-T flow
+    # Original nodes get ids 0..n-1 in name order
+    table = get_edge_table(data)
+    names = set(data["nodes"])
+    names.update(data["sources"])
+    names.update(table["names"])
+    names.update(data.get("sinks", {}))
+    if "sink" in data:
+        names.add(data["sink"])
+    names = sorted(names)
+    node_id = {node: i for i, node in enumerate(names)}
+    n = len(names)
 
-def transform_graph(data):
-    upd_nodes = set()
-    upd_edges = []
-    balance = {}
-    
-    # Nodes
-    upd_nodes.update(list(data["nodes"].keys()))
-    upd_nodes.update(list(data["sources"].keys()))
-    upd_nodes.update([u for edge in data["edges"] for u in [edge["from"], edge["to"]]])
-    
     # Node Capacity Handling
-    for node in data["nodes"]:
-        node_info = data["nodes"][node]
-        node_in = in_node(node)
-        node_out = out_node(node)
-        if len(node_info)!=0:
-            node_cap = node_info["cap"]
-            upd_nodes.remove(node)
-            upd_nodes.add(node_in)
-            upd_nodes.add(node_out)
-            upd_edges.append(make_edge(node_in, node_out, node_cap))
-            
+    # A capped node v keeps id v for its in side and gets a new id for its out side
+    node_in = np.arange(n)
+    node_out = np.arange(n)
+    split_nodes = [node_id[node] for node, node_info in data["nodes"].items() if len(node_info) != 0]
+    split_caps = [data["nodes"][names[v]]["cap"] for v in split_nodes]
+    node_out[split_nodes] = n + np.arange(len(split_nodes))
+    N = n + len(split_nodes) + (2 if terminals else 4)
+    S = N - 2
+    T = N - 1
+    SRC = N - 4
+    SNK = N - 3
+
+    # Owner of every transformed node, -1 for S and T (and SRC and SNK)
+    owner = np.full(N, -1)
+    owner[:n] = np.arange(n)
+    owner[n:n+len(split_nodes)] = split_nodes
+
+    # Fixed-point rates, maximum_flow only accepts integer capacities
+    table_id = np.array([node_id[name] for name in table["names"]], dtype=np.int64)
+    edge_from = table_id[table["from"]]
+    edge_to = table_id[table["to"]]
+    edge_lo = table["lo"]
+    # Higher caps cannot bind, so huge ones need not fit in int32
+    flow_bound = get_flow_bound(data, edge_lo.sum(), table["cost"])
+    edge_hi = np.minimum(table["hi"], edge_lo + flow_bound)
+    split_caps = np.minimum(split_caps, flow_bound)
+    supplies = list(data["sources"].values())
+    scale = get_scale(np.concatenate([edge_lo, edge_hi, split_caps, supplies, list(data.get("sinks", {}).values())]), scale)
+    edge_lo = to_fixed(edge_lo, scale)
+    edge_hi = to_fixed(edge_hi, scale)
+    split_caps = to_fixed(split_caps, scale)
+    supplies = to_fixed(supplies, scale)
+
     # Edge Lower Bound Handling
-    for edge_info in data["edges"]:
-        u = edge_info["from"]
-        v = edge_info["to"]
-        lo = edge_info["lo"]
-        hi = edge_info["hi"]
-        cap = hi - lo
-        
-        u_out = get_out_node(u, upd_nodes)
-        v_in = get_in_node(v, upd_nodes)
-        
-        upd_edges.append(make_edge(u_out,v_in,cap))
-        balance[u_out] = balance.get(u_out,0) - lo
-        balance[v_in] = balance.get(v_in,0) + lo
-        
+    balance = np.zeros(N, dtype=np.int64)
+    np.subtract.at(balance, node_out[edge_from], edge_lo)
+    np.add.at(balance, node_in[edge_to], edge_lo)
+
     # Source Sink Handling
-    for source, supply in data["sources"].items():
-        upd_nodes.add(source)
-        balance[source] = balance.get(source,0) + supply
-        
-    sink = data["sink"]
-    upd_nodes.add(sink)
-    balance[sink] = balance.get(sink,0) - sum(data["sources"].values())
-
-    total_demand = 0
-    upd_nodes.update([S, T])
-    for node in upd_nodes:
-        if balance.get(node,0) > 0:
-            total_demand += balance[node]
-            upd_edges.append(make_edge(S, node, balance[node]))
-        elif balance.get(node,0) < 0:
-            upd_edges.append(make_edge(node, T, -balance[node]))
-    
-    # Nodes to index
-    index = {}
-    label = {}
-    idx_edges = []
-    upd_nodes = sorted(list(upd_nodes))
-    for i, node in enumerate(upd_nodes):
-        index[node] = i
-        label[i] = node
-    
-    for edge in upd_edges:
-        u = edge["from"]
-        v = edge["to"]
-        cap = edge["cap"]
-        idx_edges.append([index[u], index[v], cap])
-    
+    sources = node_in[[node_id[source] for source in data["sources"]]]
+    sinks = [(sink, node_out[node_id[sink]], demand) for sink, demand in get_sink_demands(data, supplies, scale).items()]
+    term_tails, term_heads, term_caps = np.zeros((3, 0), dtype=np.int64)
+    if terminals:
+        np.add.at(balance, sources, supplies)
+        for _, v, demand in sinks:
+            balance[v] -= demand
+    else:
+        demands = np.array([demand for _, _, demand in sinks], dtype=np.int64)
+        term_tails = np.concatenate([np.full(len(sources), SRC), [v for _, v, _ in sinks], [SNK]])
+        term_heads = np.concatenate([sources, np.full(len(sinks), SNK), [SRC]])
+        term_caps = np.concatenate([supplies, demands, [max(supplies.sum(), demands.sum())]])
+        sinks = []
+
+    # Node Imbalance Handling
+    pos = np.flatnonzero(balance > 0)
+    neg = np.flatnonzero(balance < 0)
+    # Demands of "sinks" need not match the supplies, the larger side must be met
+    total_demand = int(max(balance[pos].sum(), -balance[neg].sum()))
+
+    # Transformed edges: original edges, node splits, terminal arcs, then S and T
+    # arcs. edge_orig maps back to the input edges and edge_node to the split node.
+    E = len(edge_from)
+    K = len(split_nodes)
+    extra = len(term_tails) + len(pos) + len(neg)
+    tails = np.concatenate([node_out[edge_from], split_nodes, term_tails, np.full(len(pos), S), neg]).astype(np.int64)
+    heads = np.concatenate([node_in[edge_to], node_out[split_nodes], term_heads, pos, np.full(len(neg), T)]).astype(np.int64)
+    caps = np.concatenate([edge_hi - edge_lo, split_caps, term_caps, balance[pos], -balance[neg]]).astype(np.int64)
+    edge_orig = np.concatenate([np.arange(E), np.full(K + extra, -1)])
+    edge_node = np.concatenate([np.full(E, -1), split_nodes, np.full(extra, -1)]).astype(np.int64)
+    lo = np.concatenate([edge_lo, np.zeros(len(tails) - E, dtype=np.int64)])
+
+    check_capacity(caps, total_demand, scale)
+
     # Graph
-    N = len(upd_nodes)
-    rows, cols, capacities = zip(*idx_edges)
-    graph = csr_matrix((capacities, (rows, cols)), shape=(N, N))
-    return graph, index, label, total_demand, upd_nodes
+    graph = csr_matrix((caps, (tails, heads)), shape=(N, N))
+    net = {
+        "names": names, "owner": owner, "S": S, "T": T, "graph": graph, "total_demand": total_demand, "scale": scale,
+        "tails": tails, "heads": heads, "caps": caps, "lo": lo, "edge_orig": edge_orig, "edge_node": edge_node, "sinks": sinks,
+        "edge_from": edge_from, "edge_to": edge_to, "costs": table["cost"], "flow_bound": flow_bound,
+    }
+    if not terminals:
+        net.update(source=SRC, target=SNK, return_arc=E + K + len(term_tails) - 1)
+    return net
 
 
 def remove_negative_flows(flow):
-    flow = flow.toarray()
-    flow[flow < 0] = 0
-    return csr_matrix(flow)
+    # Clip on the stored entries only, the matrix is never densified
+    flow = flow.tocsr(copy=True)
+    flow.data[flow.data < 0] = 0
+    flow.eliminate_zeros()
+    return flow
+
+def get_edge_flows(result, net):
+    # Split the flow of each (u, v) pair over its parallel edges in order
+    tails, heads, caps = net["tails"], net["heads"], net["caps"]
+    pair_flow = np.asarray(remove_negative_flows(result.flow)[tails, heads]).ravel()
+
+    order = np.lexsort((heads, tails))
+    s_tails, s_heads, s_caps = tails[order], heads[order], caps[order]
+    new_pair = np.ones(len(order), dtype=bool)
+    new_pair[1:] = (s_tails[1:] != s_tails[:-1]) | (s_heads[1:] != s_heads[:-1])
+    before = np.cumsum(s_caps) - s_caps
+    before -= before[np.flatnonzero(new_pair)][np.cumsum(new_pair) - 1]
 
-def compute_flow(result, index, data, upd_nodes):
+    flows = np.empty_like(caps)
+    flows[order] = np.clip(pair_flow[order] - before, 0, s_caps)
+    return flows
+
+def compute_flow(flows, net, data):
     flow = {}
     flow["status"] = "ok"
     flow["max_flow_per_min"] = sum(data["sources"].values())
     flow["flows"] = []
-    lo_lookup = {(e["from"], e["to"]): e["lo"] for e in data["edges"]}
-    cur_flow = remove_negative_flows(result.flow)
-
-    for u in index:
-        u_idx = index[u]
-        for v in index:
-            v_idx = index[v]
-            node_u = get_node(u)
-            node_v = get_node(v)
-            edge_flow = cur_flow[u_idx, v_idx]
-            if u == get_out_node(node_u, upd_nodes) and v == get_in_node(node_v, upd_nodes) and node_u != node_v:
-                edge_flow += lo_lookup.get((node_u, node_v), 0)
-            if u == S or v == T or node_u == node_v:
-                continue
-            if edge_flow > 0:
-                flow["flows"].append({"from": node_u, "to": node_v, "flow": edge_flow})
+    edge_flows = flows + net["lo"]
+
+    # Parallel edges are reported together, self loops are dropped
+    names, n = net["names"], len(net["names"])
+    k = np.flatnonzero(net["edge_orig"] >= 0)
+    node_u, node_v = net["edge_from"][net["edge_orig"][k]], net["edge_to"][net["edge_orig"][k]]
+    k, node_u, node_v = k[node_u != node_v], node_u[node_u != node_v], node_v[node_u != node_v]
+    pairs, inverse = np.unique(node_u * n + node_v, return_inverse=True)
+    pair_flows = np.zeros(len(pairs), dtype=edge_flows.dtype)
+    np.add.at(pair_flows, inverse, edge_flows[k])
+
+    for pair, edge_flow in zip(pairs[pair_flows > 0].tolist(), pair_flows[pair_flows > 0]):
+        flow["flows"].append({"from": names[pair // n], "to": names[pair % n], "flow": from_fixed(edge_flow, net["scale"])})
     flow["flows"] = sorted(flow["flows"], key=lambda x: (x["from"], x["to"]))
     return flow
 
-def compute_certificate(total_demand, graph, result, index, label, upd_nodes):
-    S_idx = index[S]
-    T_idx = index[T]
+def get_tight(mask, net):
+    # Split edges of mask as tight nodes, original edges as (from, to) pairs
+    tight_nodes = set()
+    tight_edges = set()
+    for k in np.flatnonzero(mask):
+        if net["edge_node"][k] >= 0:
+            tight_nodes.add(net["names"][net["edge_node"][k]])
+        else:
+            orig = net["edge_orig"][k]
+            tight_edges.add((net["names"][net["edge_from"][orig]], net["names"][net["edge_to"][orig]]))
+    return {"tight_nodes": sorted(tight_nodes), "tight_edges": [make_tight_edge(u, v) for u, v in sorted(tight_edges)]}
+
+def compute_min_cuts(residual, in_S, tight, net):
+    # The min cuts are the closed sets of the residual graph between the nodes S
+    # reaches and the nodes which cannot reach T. A tight edge u -> v carrying flow
+    # has the residual arc v -> u, so it lies in some min cut iff u cannot reach v,
+    # i.e. u and v are in different strongly connected components. It lies in
+    # every min cut iff S reaches u and v reaches T. Fixed edges (hi = lo) have no
+    # residual arc, for them the components and the two sets are only a necessary
+    # condition. One BFS each way and one SCC pass, all O(V + E).
+    N = len(net["owner"])
+    tails, heads = net["tails"], net["heads"]
+    in_T = np.zeros(N, dtype=bool)
+    in_T[breadth_first_order(residual.T.tocsr(), net["T"], directed=True, return_predecessors=False)] = True
+    _, component = connected_components(residual, directed=True, connection="strong")
+
+    every = tight & in_S[tails] & in_T[heads]
+    some = tight & ~every & (component[tails] != component[heads]) & ~in_T[tails] & ~in_S[heads]
+    source_side = np.unique(net["owner"][~in_T])
+    return {
+        "cut_reachable_max": [net["names"][v] for v in source_side if v >= 0],
+        "in_every_cut": get_tight(every, net),
+        "in_some_cut": get_tight(some, net),
+    }
+
+def compute_certificate(flows, flow_value, net, data):
+    S, T = net["S"], net["T"]
+    N = len(net["owner"])
+    names, owner = net["names"], net["owner"]
     cert = {}
     cert["status"] = "infeasible"
 
-    # Residual Graph
-    cur_flow = remove_negative_flows(result.flow)
-    residual = graph - cur_flow + cur_flow.T
+    # Residual Graph: forward arcs with spare capacity, backward arcs with flow
+    tails, heads, caps = net["tails"], net["heads"], net["caps"]
+    fwd = flows < caps
+    bwd = flows > 0
+    res_rows = np.concatenate([tails[fwd], heads[bwd]])
+    res_cols = np.concatenate([heads[fwd], tails[bwd]])
+    residual = csr_matrix((np.ones(len(res_rows)), (res_rows, res_cols)), shape=(N, N))
 
     # Cut Reachable
-    S_nodes, _ = breadth_first_order(residual, S_idx, directed=True)
-    S_nodes = set(S_nodes)
-    cut_reachable = set(S_nodes)
-    cut_reachable.remove(S_idx)
-    cut_reachable
-    cut_reachable = [get_node(label[u]) for u in cut_reachable]
-    cert["cut_reachable"] = cut_reachable
+    S_nodes = breadth_first_order(residual, S, directed=True, return_predecessors=False)
+    in_S = np.zeros(N, dtype=bool)
+    in_S[S_nodes] = True
+    reachable = np.unique(owner[S_nodes])
+    cert["cut_reachable"] = [names[v] for v in reachable if v >= 0]
 
     # Tight Nodes and Edges
     cert["deficit"] = {}
-    T_nodes = set(index.values()) - set(S_nodes)
-    tight_nodes = []
-    tight_edges = []
-    lo_lookup = {(e["from"], e["to"]): e["lo"] for e in data["edges"]}
-
-    for u in index:
-        u_idx = index[u]
-        for v in index:
-            v_idx = index[v]
-            if u_idx == S_idx or v_idx == T_idx:
-                continue
-            edge_cap = graph[u_idx, v_idx]
-            node_u = get_node(u)
-            node_v = get_node(v)
-            edge_flow = cur_flow[u_idx, v_idx]
-            if edge_flow < edge_cap:
-                continue
-            if u == get_out_node(node_u, upd_nodes) and v == get_in_node(node_v, upd_nodes):
-                edge_flow += lo_lookup.get((node_u, node_v), 0)
-            if u_idx in S_nodes and v_idx in T_nodes and edge_flow > 0:
-                if node_u == node_v:
-                    tight_nodes.append(node_u)
-                else:
-                    tight_edges.append(make_tight_edge(node_u, node_v))
-
-    cert["deficit"]["demand_balance"] = total_demand - result.flow_value
-    cert["deficit"]["tight_nodes"] = sorted(tight_nodes)
-    cert["deficit"]["tight_edges"] = sorted(tight_edges, key=lambda x: (x["from"], x["to"]))
+    tight = (flows >= caps) & (flows + net["lo"] > 0) & ((net["edge_orig"] >= 0) | (net["edge_node"] >= 0))
+    cert["deficit"]["demand_balance"] = from_fixed(net["total_demand"] - flow_value, net["scale"])
+    cert["deficit"].update(get_tight(tight & in_S[tails] & ~in_S[heads], net))
+
+    if data.get("certificate", "reachable") == "all_cuts":
+        cert["min_cuts"] = compute_min_cuts(residual, in_S, tight, net)
+
+    # Per sink shortfall: what its T arc misses, at most its own demand since the
+    # arc also carries the lower bounds of the node
+    if "sinks" in data:
+        to_T = heads == T
+        missing = np.zeros(N, dtype=np.int64)
+        np.add.at(missing, tails[to_T], caps[to_T] - flows[to_T])
+        cert["deficit"]["sink_shortfall"] = {sink: from_fixed(min(demand, missing[v]), net["scale"]) for sink, v, demand in net["sinks"]}
     return cert
     
 
-def check_feasibility(graph, index, label, total_demand, data, upd_nodes):
-    S_idx = index[S]
-    T_idx = index[T]
-    
-    result = maximum_flow(graph, S_idx, T_idx)
+def check_feasibility(net, data):
+    result = maximum_flow(net["graph"], net["S"], net["T"])
     max_flow = result.flow_value
+    flows = get_edge_flows(result, net)
     
-    if max_flow == total_demand:
-        flow = compute_flow(result, index, data, upd_nodes)
+    if max_flow == net["total_demand"]:
+        flow = compute_flow(flows, net, data)
         return flow     
     else:
-        cert = compute_certificate(total_demand, graph, result, index, label, upd_nodes)
+        cert = compute_certificate(flows, max_flow, net, data)
         return cert
-            
+
+def augment_flow(net, flows, keep, source, target):
+    # Adds the max flow from source to target in the residual graph of flows over
+    # the edges in keep. Parallel residual arcs share one entry of the matrix, its
+    # flow is split over them in order.
+    N = len(net["owner"])
+    tails, heads = net["tails"][keep], net["heads"][keep]
+    arc_tail = np.concatenate([tails, heads])
+    arc_head = np.concatenate([heads, tails])
+    arc_res = np.concatenate([net["caps"][keep] - flows[keep], flows[keep]])
+    pairs, inverse = np.unique(arc_tail * N + arc_head, return_inverse=True)
+    pair_caps = np.minimum(np.bincount(inverse, arc_res, len(pairs)), MAX_CAPACITY).astype(np.int64)
+    indptr = np.searchsorted(pairs // N, np.arange(N + 1))
+    result = maximum_flow(csr_matrix((pair_caps, pairs % N, indptr), shape=(N, N)), source, target, method="dinic")
+
+    pair_flow = np.maximum(np.asarray(result.flow[pairs // N, pairs % N]).ravel(), 0)
+    order = np.argsort(inverse, kind="stable")
+    s_res = arc_res[order]
+    before = np.cumsum(s_res) - s_res
+    first = np.searchsorted(inverse[order], inverse[order])
+    before -= before[first]
+    amount = np.empty_like(arc_res)
+    amount[order] = np.clip(pair_flow[inverse[order]] - before, 0, s_res)
+    flows[keep] += amount[:len(tails)] - amount[len(tails):]
+
+def solve_max_flow(net, data):
+    # Lower bounds first: a circulation through the return arc which meets every
+    # lo, then the max flow from SRC to SNK in its residual graph without that arc
+    result = maximum_flow(net["graph"], net["S"], net["T"])
+    flows = get_edge_flows(result, net)
+    if result.flow_value < net["total_demand"]:
+        return compute_certificate(flows, result.flow_value, net, data)
+
+    tails, heads = net["tails"], net["heads"]
+    keep = (tails != net["S"]) & (heads != net["T"]) & (tails != heads)
+    keep[net["return_arc"]] = False
+    augment_flow(net, flows, keep, net["source"], net["target"])
+    flow = compute_flow(flows, net, data)
+    flow["max_flow_per_min"] = from_fixed(flows[keep & (tails == net["source"])].sum(), net["scale"])
+    return flow
+
+def solve_min_cost(net, data):
+    # The max flow decides feasibility and gives the certificate, a feasible
+    # network is then solved again as an LP over the inner edges: the S arcs are
+    # saturated, so every node sends out exactly its balance. The constraint
+    # matrix is an incidence matrix, so the simplex vertex is integral.
+    result = maximum_flow(net["graph"], net["S"], net["T"])
+    flows = get_edge_flows(result, net)
+    if result.flow_value < net["total_demand"]:
+        return compute_certificate(flows, result.flow_value, net, data)
+
+    N = len(net["owner"])
+    S, T = net["S"], net["T"]
+    tails, heads, caps = net["tails"], net["heads"], net["caps"]
+    inner = (tails != S) & (heads != T)
+    balance = np.zeros(N)
+    np.add.at(balance, heads[tails == S], caps[tails == S])
+    np.subtract.at(balance, tails[heads == T], caps[heads == T])
+
+    k = np.flatnonzero(inner)
+    cost = np.where(net["edge_orig"] >= 0, net["costs"][net["edge_orig"]], 0.0)
+    A_eq = csr_matrix((np.concatenate([np.ones(len(k)), -np.ones(len(k))]), (np.concatenate([tails[k], heads[k]]), np.tile(np.arange(len(k)), 2))), shape=(N, len(k)))
+    lp = linprog(cost[k], A_eq=A_eq, b_eq=balance, bounds=np.column_stack([np.zeros(len(k)), caps[k]]), method="highs-ds")
+    if not lp.success:
+        raise RuntimeError(f"Min-cost LP failed: {lp.message}")
+    flows[k] = np.rint(lp.x).astype(np.int64)
+
+    flow = compute_flow(flows, net, data)
+    flow["total_cost"] = from_fixed(float(cost @ (flows + net["lo"])), net["scale"])
+    return flow
+
+def solve(data, scale=SCALE):
+    mode = data.get("mode", "feasibility")
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}, expected one of {', '.join(MODES)}")
+    if data.get("certificate", "reachable") not in CERTIFICATES:
+        raise ValueError(f"Unknown certificate {data['certificate']}, expected one of {', '.join(CERTIFICATES)}")
+    net = transform_graph(data, scale, terminals=mode != "max_flow")
+    if mode == "max_flow":
+        return solve_max_flow(net, data)
+    if mode == "min_cost":
+        return solve_min_cost(net, data)
+    return check_feasibility(net, data)
+
+EDIT_OPS = ("set_edge", "add_edge", "remove_edge", "set_node_cap", "set_supply", "set_demand")
+
+class BeltSession:
+    # Keeps the transformed graph and the last flow between edits. An edit only
+    # touches the arrays of the edge, node or supply it names. solve() clips the
+    # kept flow to the new capacities and refills the S/T arcs as far as it allows;
+    # the nodes left with too much or too little inflow are then balanced with
+    # augmenting paths in the residual graph, from a super source S2 (feeding those
+    # nodes and S) to a super sink T2. The edited network is feasible iff S2 gets
+    # saturated, and the kept plus augmented flow is then a feasible flow.
+    # Infeasible networks are solved from scratch for their certificate.
+    def __init__(self, data, scale=SCALE):
+        if data.get("mode", "feasibility") != "feasibility":
+            raise ValueError("Sessions only check feasibility, mode must be feasibility")
+        self.data = data
+        self.scale_arg = scale
+        self.removed = np.zeros(len(data["edges"]), dtype=bool)
+        self.repairs = 0
+        self.full_solves = 0
+        self.build()
+
+    def build(self):
+        net = transform_graph(self.data, self.scale_arg)
+        self.scale = net["scale"]
+        self.names = list(net["names"])
+        self.node_id = {node: i for i, node in enumerate(self.names)}
+        self.S, self.T = net["S"], net["T"]
+        self.owner = net["owner"].copy()
+
+        # S and T arcs are rebuilt from the balances, only the inner edges are kept
+        inner = (net["edge_orig"] >= 0) | (net["edge_node"] >= 0)
+        self.tails, self.heads, self.caps, self.lo = (net[key][inner] for key in ("tails", "heads", "caps", "lo"))
+        self.edge_orig, self.edge_node = net["edge_orig"][inner], net["edge_node"][inner]
+        self.edge_pos = np.flatnonzero(self.edge_orig >= 0).tolist()
+        self.orig_from, self.orig_to = net["edge_from"], net["edge_to"]
+        self.costs, self.flow_bound = net["costs"], net["flow_bound"]
+        self.node_in = np.arange(len(self.names))
+        self.node_out = np.arange(len(self.names))
+        split = self.edge_node >= 0
+        self.node_out[self.edge_node[split]] = self.heads[split]
+        self.split_pos = dict(zip(self.edge_node[split].tolist(), np.flatnonzero(split).tolist()))
+        self.flow = None
+        self.structure = None
+
+    def fits(self, values):
+        # An automatic scale is raised by rebuilding when an edit needs more digits
+        if self.scale_arg is None and not is_integral(np.asarray(values, dtype=float), self.scale):
+            self.build()
+            return False
+        return True
+
+    def fixed(self, value):
+        return int(to_fixed(value, self.scale))
+
+    def get_node(self, name):
+        # Unknown names become new uncapped nodes after S and T
+        if name not in self.node_id:
+            self.node_id[name] = len(self.names)
+            self.names.append(name)
+            self.node_in = np.append(self.node_in, len(self.owner))
+            self.node_out = np.append(self.node_out, len(self.owner))
+            self.owner = np.append(self.owner, self.node_id[name])
+            self.structure = None
+        return self.node_id[name]
+
+    def add_inner_edge(self, tail, head, cap, lo, orig, node):
+        self.tails = np.append(self.tails, tail)
+        self.heads = np.append(self.heads, head)
+        self.caps = np.append(self.caps, cap)
+        self.lo = np.append(self.lo, lo)
+        self.edge_orig = np.append(self.edge_orig, orig)
+        self.edge_node = np.append(self.edge_node, node)
+        if self.flow is not None:
+            self.flow = np.append(self.flow, 0)
+        self.structure = None
+        return len(self.tails) - 1
+
+    def find_edge(self, u, v):
+        for i, edge in enumerate(self.data["edges"]):
+            if edge["from"] == u and edge["to"] == v and not self.removed[i]:
+                return i
+        raise ValueError(f"No edge from {u} to {v}")
+
+    def set_edge(self, u, v, lo=None, hi=None):
+        i = self.find_edge(u, v)
+        edge = self.data["edges"][i]
+        edge["lo"] = edge["lo"] if lo is None else lo
+        edge["hi"] = edge["hi"] if hi is None else hi
+        if edge["hi"] < edge["lo"]:
+            raise ValueError(f"Edge from {u} to {v} has hi below lo")
+        if self.fits([edge["lo"], edge["hi"]]):
+            k = self.edge_pos[i]
+            self.lo[k] = self.fixed(edge["lo"])
+            # Clamped to the flow bound of the last build, as in transform_graph
+            self.caps[k] = self.fixed(min(edge["hi"], edge["lo"] + self.flow_bound)) - self.lo[k]
+
+    def add_edge(self, u, v, lo=0, hi=0):
+        if hi < lo:
+            raise ValueError(f"Edge from {u} to {v} has hi below lo")
+        self.data["edges"].append({"from": u, "to": v, "lo": lo, "hi": hi})
+        self.removed = np.append(self.removed, False)
+        if self.fits([lo, hi]):
+            u_id, v_id = self.get_node(u), self.get_node(v)
+            tail, head = self.node_out[u_id], self.node_in[v_id]
+            self.orig_from = np.append(self.orig_from, u_id)
+            self.orig_to = np.append(self.orig_to, v_id)
+            k = self.add_inner_edge(tail, head, self.fixed(min(hi, lo + self.flow_bound)) - self.fixed(lo), self.fixed(lo), len(self.data["edges"]) - 1, -1)
+            self.edge_pos.append(k)
+
+    def remove_edge(self, u, v):
+        # The edge stays in place with zero bounds, so no index moves
+        i = self.find_edge(u, v)
+        self.data["edges"][i].update(lo=0, hi=0)
+        self.removed[i] = True
+        k = self.edge_pos[i]
+        self.lo[k] = self.caps[k] = 0
+
+    def set_node_cap(self, node, cap):
+        # cap None removes the cap, the split edge is then left unbounded
+        self.data["nodes"][node] = {} if cap is None else {"cap": cap}
+        if cap is not None and not self.fits([cap]):
+            return
+        v = self.get_node(node)
+        fixed_cap = MAX_CAPACITY if cap is None else self.fixed(min(cap, self.flow_bound))
+        if v in self.split_pos:
+            self.caps[self.split_pos[v]] = fixed_cap
+        elif cap is not None:
+            # Split v: its outgoing edges move to a new out node behind the cap
+            out = len(self.owner)
+            self.owner = np.append(self.owner, v)
+            self.tails[(self.tails == self.node_in[v]) & (self.edge_node < 0)] = out
+            self.node_out[v] = out
+            self.split_pos[v] = self.add_inner_edge(self.node_in[v], out, fixed_cap, 0, -1, v)
+
+    def set_supply(self, source, rate):
+        self.data["sources"][source] = rate
+        if self.fits([rate]):
+            self.get_node(source)
+
+    def set_demand(self, sink, rate):
+        self.data.setdefault("sinks", {})[sink] = rate
+        if self.fits([rate]):
+            self.get_node(sink)
+
+    def apply(self, edits):
+        for edit in edits if isinstance(edits, list) else [edits]:
+            op = edit.get("op")
+            if op == "set_edge":
+                self.set_edge(edit["from"], edit["to"], edit.get("lo"), edit.get("hi"))
+            elif op == "add_edge":
+                self.add_edge(edit["from"], edit["to"], edit.get("lo", 0), edit.get("hi", 0))
+            elif op == "remove_edge":
+                self.remove_edge(edit["from"], edit["to"])
+            elif op == "set_node_cap":
+                self.set_node_cap(edit["node"], edit.get("cap"))
+            elif op == "set_supply":
+                self.set_supply(edit["source"], edit["rate"])
+            elif op == "set_demand":
+                self.set_demand(edit["sink"], edit["rate"])
+            else:
+                raise ValueError(f"Unknown edit {op}, expected one of {', '.join(EDIT_OPS)}")
+
+    def get_balance(self):
+        N = len(self.owner)
+        balance = np.bincount(self.heads, self.lo, N).astype(np.int64) - np.bincount(self.tails, self.lo, N).astype(np.int64)
+        sources = [self.node_in[self.node_id[source]] for source in self.data["sources"]]
+        supplies = to_fixed(list(self.data["sources"].values()), self.scale)
+        np.add.at(balance, np.asarray(sources, dtype=np.int64), supplies)
+        self.sinks = [(sink, self.node_out[self.node_id[sink]], demand) for sink, demand in get_sink_demands(self.data, supplies, self.scale).items()]
+        for _, v, demand in self.sinks:
+            balance[v] -= demand
+        return balance
+
+    def get_net(self, balance):
+        pos = np.flatnonzero(balance > 0)
+        neg = np.flatnonzero(balance < 0)
+        extra = len(pos) + len(neg)
+        net = {
+            "names": self.names, "owner": self.owner, "S": self.S, "T": self.T,
+            "total_demand": int(max(balance[pos].sum(), -balance[neg].sum())), "scale": self.scale,
+            "tails": np.concatenate([self.tails, np.full(len(pos), self.S), neg]),
+            "heads": np.concatenate([self.heads, pos, np.full(len(neg), self.T)]),
+            "caps": np.concatenate([self.caps, balance[pos], -balance[neg]]),
+            "lo": np.concatenate([self.lo, np.zeros(extra, dtype=np.int64)]),
+            "edge_orig": np.concatenate([self.edge_orig, np.full(extra, -1)]),
+            "edge_node": np.concatenate([self.edge_node, np.full(extra, -1)]), "sinks": self.sinks,
+            "edge_from": self.orig_from, "edge_to": self.orig_to,
+        }
+        check_capacity(net["caps"], net["total_demand"], self.scale)
+        return net
+
+    def get_structure(self):
+        # Residual graph with S2 = N and T2 = N + 1. Arcs: inner edges, their
+        # reverses, S arcs and reverses, T arcs and reverses, S2 and T2 arcs, then
+        # S2 -> S and T -> T2. Parallel arcs share one (tail, head) pair, whose
+        # arcs are order[start[p]:start[p+1]].
+        N = len(self.owner)
+        S, T, S2, T2 = self.S, self.T, N, N + 1
+        nodes = np.setdiff1d(np.arange(N), [S, T])
+        E, k = len(self.tails), len(nodes)
+        arc_tail = np.concatenate([self.tails, self.heads, np.full(k, S), nodes, nodes, np.full(k, T), np.full(k, S2), nodes, [S2, T]])
+        arc_head = np.concatenate([self.heads, self.tails, nodes, np.full(k, S), np.full(k, T), nodes, nodes, np.full(k, T2), [S, T2]])
+        pairs, inverse = np.unique(arc_tail * (N + 2) + arc_head, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        start = np.searchsorted(inverse[order], np.arange(len(pairs) + 1))
+
+        # Arcs into S2 or out of T2 are never used, so those arcs have no partner
+        partner = np.full(len(arc_tail), -1)
+        paired = np.arange(2*E + 4*k)
+        partner[paired] = np.concatenate([paired[E:2*E], paired[:E], paired[2*E+k:2*E+2*k], paired[2*E:2*E+k], paired[2*E+3*k:], paired[2*E+2*k:2*E+3*k]])
+        cols = pairs % (N + 2)
+        return SimpleNamespace(
+            nodes=nodes, pairs=pairs, rows=pairs // (N + 2), cols=cols, ends=np.flatnonzero(cols == T2),
+            inverse=inverse, order=order, start=start, partner=partner,
+        )
+
+    def augment(self, st, res, pair_res, path, amount):
+        # Pushes amount along the pairs of path, filling their arcs in order
+        for p in path:
+            left = amount
+            for a in st.order[st.start[p]:st.start[p+1]]:
+                push = min(left, res[a])
+                if push > 0:
+                    res[a] -= push
+                    pair_res[p] -= push
+                    if st.partner[a] >= 0:
+                        res[st.partner[a]] += push
+                        pair_res[st.inverse[st.partner[a]]] += push
+                    left -= push
+                if left == 0:
+                    break
+
+    def repair(self, balance):
+        # True once self.flow is a feasible flow of the edited network
+        N = len(self.owner)
+        S2, T2 = N, N + 1
+        supply = np.maximum(balance, 0)
+        demand = np.maximum(-balance, 0)
+        total = int(supply.sum())
+        if total != demand.sum():
+            return False
+        flow = np.clip(self.flow, 0, self.caps)
+        out = np.bincount(self.tails, flow, N).astype(np.int64) - np.bincount(self.heads, flow, N).astype(np.int64)
+        s_in = np.clip(out, 0, supply)
+        t_out = np.clip(-out, 0, demand)
+        excess = s_in - t_out - out
+        need = total - int(s_in.sum()) + int(np.maximum(excess, 0).sum())
+        if need == 0:
+            self.flow = flow
+            return True
+
+        if self.structure is None:
+            self.structure = self.get_structure()
+        st = self.structure
+        v = st.nodes
+        res = np.concatenate([
+            self.caps - flow, flow, supply[v] - s_in[v], s_in[v], demand[v] - t_out[v], t_out[v],
+            np.maximum(excess[v], 0), np.maximum(-excess[v], 0), [total - s_in.sum(), total - t_out.sum()],
+        ])
+        pair_res = np.bincount(st.inverse, res, len(st.pairs)).astype(np.int64)
+
+        # Each round is one BFS from S2 over the pairs with residual capacity left,
+        # then an augmenting path along the BFS tree to every node reached with an
+        # arc into T2. With no path left the S2 - T2 flow is maximum.
+        for _ in range(REPAIR_ROUNDS):
+            live = pair_res > 0
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(st.rows[live], minlength=N + 2))])
+            graph = csr_matrix((np.ones(live.sum()), st.cols[live], indptr), shape=(N + 2, N + 2))
+            _, pred = breadth_first_order(graph, S2, directed=True, return_predecessors=True)
+            if pred[T2] < 0:
+                return False
+            for p in st.ends[live[st.ends] & (pred[st.rows[st.ends]] >= 0)]:
+                nodes = [st.rows[p]]
+                while nodes[-1] != S2:
+                    nodes.append(pred[nodes[-1]])
+                path = np.searchsorted(st.pairs, np.array(nodes[1:]) * (N + 2) + nodes[:-1])
+                path = np.append(path, p)
+                amount = min(int(pair_res[path].min()), need)
+                if amount > 0:
+                    self.augment(st, res, pair_res, path, amount)
+                    need -= amount
+                if need == 0:
+                    self.flow = res[len(flow):2*len(flow)].copy()
+                    return True
+        return False
+
+    def raise_flow_bound(self, flow_bound):
+        # Edits raised the totals by at least one fixed-point unit, so caps clamped
+        # to the old bound are clamped again from the request. They only grow, so
+        # the kept flow stays within them.
+        clamped = np.flatnonzero(self.caps >= self.flow_bound * self.scale - 1).tolist()
+        his = []
+        for k in clamped:
+            if self.edge_orig[k] >= 0:
+                edge = self.data["edges"][self.edge_orig[k]]
+                his.append(min(edge["hi"], edge["lo"] + flow_bound))
+            else:
+                his.append(min(self.data["nodes"][self.names[self.edge_node[k]]].get("cap", np.inf), flow_bound))
+        if not self.fits(his):
+            return
+        self.flow_bound = flow_bound
+        for k, hi in zip(clamped, his):
+            self.caps[k] = self.fixed(hi) - self.lo[k]
+
+    def solve(self):
+        flow_bound = get_flow_bound(self.data, from_fixed(self.lo.sum(), self.scale), self.costs)
+        if (flow_bound - self.flow_bound) * self.scale >= 0.5:
+            self.raise_flow_bound(flow_bound)
+        balance = self.get_balance()
+        net = self.get_net(balance)
+        if self.flow is not None and self.repair(balance):
+            self.repairs += 1
+            flows = np.concatenate([self.flow, net["caps"][len(self.flow):]])
+            return compute_flow(flows, net, self.data)
+        return self.solve_full(net)
+
+    def solve_full(self, net):
+        self.full_solves += 1
+        net["graph"] = csr_matrix((net["caps"], (net["tails"], net["heads"])), shape=(len(self.owner), len(self.owner)))
+        result = maximum_flow(net["graph"], self.S, self.T)
+        flows = get_edge_flows(result, net)
+        self.flow = flows[:len(self.tails)]
+        if result.flow_value == net["total_demand"]:
+            return compute_flow(flows, net, self.data)
+        return compute_certificate(flows, result.flow_value, net, self.data)
+
+def serve_session(infile, outfile, scale=SCALE):
+    # The first line is the network, every later line an edit or a list of edits,
+    # answered with the result for the network edited so far
+    sessions = []
+    def respond(data):
+        if sessions:
+            sessions[0].apply(data)
+        else:
+            sessions.append(BeltSession(data, scale))
+        return format_json(sessions[0].solve(), indent=None)
+    serve_lines(respond, infile, outfile, sort_keys=True)
+
+def respond(data, cache=None, scale=SCALE, indent=4):
+    if cache is None:
+        return format_json(solve(data, scale), indent)
+
+    key = cache.key(data, scale, indent)
+    output = cache.get(key)
+    if output is None:
+        output = format_json(solve(data, scale), indent)
+        cache.put(key, output)
+    return output
+
 if __name__=="__main__":
-    data = scan_input()
-    graph, index, label, total_demand, upd_nodes = transform_graph(data)
-    resp = check_feasibility(graph, index, label, total_demand, data, upd_nodes)
-    print_json(resp)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=SCALE, help="fixed-point scale for fractional rates, picked automatically by default")
+    parser.add_argument("--session", action="store_true", help="read a network and then one edit per line from stdin, re-solving incrementally after each")
+    parser.add_argument("--ndjson", action="store_true", help="read the request without edges on the first line and one edge per line after it")
+    parser.add_argument("--compact", action="store_true", help="print the result on a single line")
+    parser.add_argument("--cache", action="store_true", help="reuse the output of identical requests")
+    parser.add_argument("--cache-dir", help="also keep cached outputs in this directory across runs")
+    parser.add_argument("--cache-max-bytes", type=int, default=64 * 2**20, help="size limit of the cache directory")
+    parser.add_argument("--cache-stats", action="store_true", help="print cache hit/miss counters to stderr on exit")
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache or args.cache_dir:
+        cache = ResultCache("belts", CACHE_VERSION, args.cache_dir, max_bytes=args.cache_max_bytes)
+
+    if args.session:
+        serve_session(sys.stdin, sys.stdout, args.scale)
+        exit()
+
+    indent = None if args.compact else 4
+    data = scan_ndjson(sys.stdin) if args.ndjson else scan_input()
+    try:
+        if cache is None or args.ndjson:
+            write_json(solve(data, args.scale), sys.stdout, indent)
+        else:
+            print(respond(data, cache, args.scale, indent))
+    except OverflowError as e:
+        print(e)
+        exit()
+    if cache is not None and args.cache_stats:
+        print(json.dumps(cache.stats()), file=sys.stderr)
@@ -0,0 +1,205 @@
+# Shared by factory/helpers.py and belts/helpers.py: the line protocol, the
+# streaming JSON encoder and the result cache
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from json.encoder import encode_basestring_ascii
+import numpy as np
+
+def handle_line(respond, line, sort_keys=False):
+    # One request per line in, one compact response per line out
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return json.dumps({"status": "error", "message": "Invalid Input"}, sort_keys=sort_keys)
+    try:
+        return respond(data)
+    except Exception as e:
+        return json.dumps({"status": "error", "message": f"{type(e).__name__}: {e}"}, sort_keys=sort_keys)
+
+def serve_lines(respond, infile, outfile, sort_keys=False):
+    for line in infile:
+        if not line.strip():
+            continue
+        outfile.write(handle_line(respond, line, sort_keys) + "\n")
+        outfile.flush()
+
+CONTAINERS = (dict, list, tuple, np.ndarray)
+# Items per chunk of a compact list encoded by json itself
+JSON_SLICE = 1024
+
+def encode_key(key):
+    return encode_basestring_ascii(key if isinstance(key, str) else encode_scalar(key, float.__repr__))
+
+def encode_scalar(obj, format_float):
+    kind = type(obj)
+    if kind is float or isinstance(obj, (float, np.floating)):
+        obj = float(obj)
+        if obj != obj:
+            return "NaN"
+        if obj in (math.inf, -math.inf):
+            return "Infinity" if obj > 0 else "-Infinity"
+        return format_float(obj)
+    if kind is str:
+        return encode_basestring_ascii(obj)
+    if obj is None:
+        return "null"
+    if obj is True or obj is False or isinstance(obj, np.bool_):
+        return "true" if obj else "false"
+    if isinstance(obj, (int, np.integer)):
+        return int.__repr__(int(obj))
+    if isinstance(obj, str):
+        return encode_basestring_ascii(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def iter_json(obj, indent=4, sort_keys=False, format_float=float.__repr__, level=0):
+    # The text of json.dumps(obj, indent=indent, sort_keys=sort_keys) in chunks,
+    # without converting obj or building the whole string first
+    if isinstance(obj, np.ndarray):
+        obj = obj.tolist()
+    is_dict = isinstance(obj, dict)
+    if not is_dict and not isinstance(obj, (list, tuple)):
+        yield encode_scalar(obj, format_float)
+        return
+    if not obj:
+        yield "{}" if is_dict else "[]"
+        return
+
+    if indent is None:
+        first, separator, last = "", ", ", ""
+    else:
+        first = "\n" + " " * (indent * (level + 1))
+        separator = "," + first
+        last = "\n" + " " * (indent * level)
+    items = (sorted(obj.items()) if sort_keys else obj.items()) if is_dict else enumerate(obj)
+    if not any(isinstance(value, CONTAINERS) for value in (obj.values() if is_dict else obj)):
+        # Flat containers (most of a large output) are encoded in one chunk
+        if is_dict:
+            parts = [encode_key(key) + ": " + encode_scalar(value, format_float) for key, value in items]
+        else:
+            parts = [encode_scalar(value, format_float) for value in obj]
+        yield ("{" if is_dict else "[") + first + separator.join(parts) + last + ("}" if is_dict else "]")
+        return
+
+    if indent is None and format_float is float.__repr__ and not is_dict:
+        # Compact lists go through the C encoder of json a slice at a time
+        encoder = json.JSONEncoder(sort_keys=sort_keys)
+        for start in range(0, len(obj), JSON_SLICE):
+            chunk = obj[start:start+JSON_SLICE]
+            prefix = ", " if start else "["
+            try:
+                yield prefix + encoder.encode(chunk)[1:-1]
+            except TypeError:
+                # NumPy values, item by item
+                for i, value in enumerate(chunk):
+                    yield ", " if i else prefix
+                    yield from iter_json(value, indent, sort_keys, format_float, level + 1)
+        yield "]"
+        return
+
+    yield ("{" if is_dict else "[") + first
+    for i, (key, value) in enumerate(items):
+        prefix = separator if i else ""
+        if is_dict:
+            prefix += encode_key(key) + ": "
+        if isinstance(value, CONTAINERS):
+            yield prefix
+            yield from iter_json(value, indent, sort_keys, format_float, level + 1)
+        else:
+            yield prefix + encode_scalar(value, format_float)
+    yield last + ("}" if is_dict else "]")
+
+class ResultCache:
+    # Solver output keyed on a canonical hash of the input JSON. An in-memory LRU
+    # sits in front of an optional directory of files evicted oldest-first once
+    # their total size exceeds max_bytes. get and put hold a lock, since the
+    # threads of serve_socket share one cache. The key includes the solver's
+    # version, so outputs written by an older solver are not served after a change.
+    def __init__(self, namespace, version, directory=None, max_entries=256, max_bytes=64 * 2**20):
+        self.namespace = namespace
+        self.version = version
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_bytes = sum(size for _, size, _ in self.disk_entries())
+
+    def key(self, data, *options):
+        canonical = json.dumps([self.namespace, self.version, options, data], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def disk_entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            if self.directory is not None:
+                path = os.path.join(self.directory, key + ".json")
+                try:
+                    with open(path) as f:
+                        output = f.read()
+                    os.utime(path)
+                except OSError:
+                    output = None
+                if output is not None:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self.remember(key, output)
+                    return output
+
+            self.misses += 1
+            return None
+
+    def remember(self, key, output):
+        self.memory[key] = output
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def put(self, key, output):
+        with self.lock:
+            self.remember(key, output)
+            if self.directory is None:
+                return
+
+            path = os.path.join(self.directory, key + ".json")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(output)
+            os.replace(tmp_path, path)
+            self.disk_bytes += os.path.getsize(path)
+
+            if self.disk_bytes > self.max_bytes:
+                entries = sorted(self.disk_entries())
+                self.disk_bytes = sum(size for _, size, _ in entries)
+                for _, size, old_path in entries:
+                    if self.disk_bytes <= self.max_bytes or old_path == path:
+                        break
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        continue
+                    self.disk_bytes -= size
+
+    def stats(self):
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
@@ -1,5 +1,12 @@
 import json
+import os
+import socketserver
 import sys
+from contextlib import contextmanager
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import *
 
 def scan_input():
     try:
@@ -8,8 +15,51 @@ def scan_input():
         print("Invalid Input")
         exit()
 
+@contextmanager
+def quiet_stdout():
+    # Sends what native code prints to file descriptor 1 to /dev/null, so it cannot
+    # end up in the JSON output
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+def format_soln(soln, indent=4):
+    return json.dumps(format_floats(soln), indent=indent)
+
 def print_soln(soln):
-    print(json.dumps(format_floats(soln), indent=4))
+    print(format_soln(soln))
+
+def serve_socket(respond, path):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                self.wfile.write((handle_line(respond, line) + "\n").encode())
+                self.wfile.flush()
+
+    if os.path.exists(path):
+        os.remove(path)
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+def format_float(value):
+    return float.__repr__(float(f"{value:.9f}"))
+
+def write_soln(soln, out, indent=4):
+    # Same text as print(format_soln(soln, indent), file=out), streamed
+    out.writelines(iter_json(soln, indent, format_float=format_float))
+    out.write("\n")
 
 def format_floats(obj):
     if isinstance(obj, float):
@@ -1,58 +1,145 @@
 from helpers import *
+import argparse
+import copy
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from scipy.optimize import linprog
+from scipy.optimize import Bounds, LinearConstraint, linprog, milp
+from scipy.sparse import coo_matrix, csr_matrix, hstack, identity, vstack
 
 TOL = 1e-9
+# Default primal feasibility tolerance of HiGHS, used to accept warm started solutions
+FEAS_TOL = 1e-7
+# Relative tolerance and solve budget for the throughput curve
+CURVE_TOL = 1e-7
+CURVE_MAX_SOLVES = 200
+# Cap tightening rounds of the integer rounding heuristic and default MILP budget
+ROUND_MAX_REPAIRS = 20
+MILP_TIME_LIMIT_S = 10.0
+# Module kinds which can be allocated per recipe
+MODULE_KINDS = ("prod", "speed")
+# Relative slack left on an objective while the next lexicographic one is minimized
+LEX_TOL = 1e-7
+# Part of every result cache key, bump it whenever the output for a request changes
+CACHE_VERSION = 4
 linprog_options = {
     "tol":TOL
 }
 
-def get_obj_rcp_prod_rate(obj, recipe_info, machines):
+def get_eff_craft_per_min(recipe_info, machines):
     machine_type = recipe_info["machine"]
-    prod = machines[machine_type].get("prod", 0.0)
     speed = machines[machine_type].get("speed", 0.0)
     time_s = recipe_info["time_s"]
-    eff_craft_per_min = machines[machine_type]["crafts_per_min"] * (1 + speed) * 60 / time_s
+    return machines[machine_type]["crafts_per_min"] * (1 + speed) * 60 / time_s
 
-    obj_prod_rate = 0.0
+def create_item_matrix(recipes, machines, objects):
+    # Net production rate of every object per machine of every recipe, built in a
+    # single pass over the in/out dicts. New objects are appended to `objects`.
+    rows = []
+    cols = []
+    vals = []
+    for j, recipe_info in enumerate(recipes.values()):
+        eff_craft_per_min = get_eff_craft_per_min(recipe_info, machines)
+        prod = machines[recipe_info["machine"]].get("prod", 0.0)
+        for obj, count in recipe_info["in"].items():
+            rows.append(objects.setdefault(obj, len(objects)))
+            cols.append(j)
+            vals.append(-count * eff_craft_per_min)
+        for obj, count in recipe_info["out"].items():
+            rows.append(objects.setdefault(obj, len(objects)))
+            cols.append(j)
+            vals.append(count * eff_craft_per_min * (1+prod))
 
-    if obj in recipe_info["in"]:
-        obj_prod_rate -= recipe_info["in"][obj] * eff_craft_per_min
+    # Duplicate entries (an object both in "in" and "out") are summed
+    return coo_matrix((vals, (rows, cols)), shape=(len(objects), len(recipes))).tocsr()
 
-    if obj in recipe_info["out"]:
-        obj_prod_rate += recipe_info["out"][obj] * eff_craft_per_min * (1+prod)
+def compile_book(data):
+    # Recipe book index: the in/out counts of every recipe as sparse triplets over
+    # object ids, the recipe machines and times, and the machine costs. Modules and machine speeds only
+    # scale the columns, so the item matrix of any request is one vectorized product.
+    recipes = data["recipes"]
+    machine_types = list(data["machines"])
+    machine_index = {machine_type: i for i, machine_type in enumerate(machine_types)}
+    objects = {}
+    book = {"in": ([], [], []), "out": ([], [], [])}
+    for j, recipe_info in enumerate(recipes.values()):
+        for side in ("in", "out"):
+            rows, cols, counts = book[side]
+            for obj, count in recipe_info[side].items():
+                rows.append(objects.setdefault(obj, len(objects)))
+                cols.append(j)
+                counts.append(count)
 
-    return obj_prod_rate
+    index = {}
+    for side in ("in", "out"):
+        rows, cols, counts = book[side]
+        index[f"{side}_rows"] = np.array(rows, dtype=np.int32)
+        index[f"{side}_cols"] = np.array(cols, dtype=np.int32)
+        index[f"{side}_counts"] = np.array(counts, dtype=float)
+    index["objects"] = np.array(list(objects), dtype=str)
+    index["recipes"] = np.array(list(recipes), dtype=str)
+    index["recipe_machine"] = np.array([machine_index[recipe_info["machine"]] for recipe_info in recipes.values()], dtype=np.int32)
+    index["time_s"] = np.array([recipe_info["time_s"] for recipe_info in recipes.values()], dtype=float)
+    index["machines"] = np.array(machine_types, dtype=str)
+    index["crafts_per_min"] = np.array([data["machines"][machine_type]["crafts_per_min"] for machine_type in machine_types], dtype=float)
+    index["power_kw"] = np.array([data["machines"][machine_type].get("power_kw", 0.0) for machine_type in machine_types], dtype=float)
+    index["footprint"] = np.array([data["machines"][machine_type].get("footprint", 0.0) for machine_type in machine_types], dtype=float)
+    modules = data.get("modules", {})
+    index["module_prod"] = np.array([modules.get(machine_type, {}).get("prod", 0.0) for machine_type in machine_types])
+    index["module_speed"] = np.array([modules.get(machine_type, {}).get("speed", 0.0) for machine_type in machine_types])
+    canonical = json.dumps([data["machines"], recipes, modules], sort_keys=True, separators=(",", ":"))
+    index["digest"] = np.array(hashlib.sha256(canonical.encode()).hexdigest())
+    return index
 
-def get_obj_eqn(obj, recipes, machines):
-    R = len(recipes)
-    eqn = np.zeros(R)
-    for i, recipe in enumerate(recipes):
-        recipe_info = recipes[recipe]
-        eqn[i] = get_obj_rcp_prod_rate(obj, recipe_info, machines)
-    return eqn
+def save_book(data, path):
+    index = compile_book(data)
+    np.savez(path, **index)
+    return {"status": "ok", "recipes": len(index["recipes"]), "items": len(index["objects"]), "machines": len(index["machines"])}
 
-def create_equations(data):
-    # Process the data
-    recipes = data["recipes"]
-    R = len(recipes)
-    machine_types = list(data["machines"].keys())
-    M = len(machine_types)
-    supplies = list(data["limits"]["raw_supply_per_min"].keys())
-    S = len(supplies)
-    target = data["target"]["item"]
-    target_rate = data["target"]["rate_per_min"]
-    modules = data["modules"]
+def load_book(path):
+    with np.load(path) as index:
+        return {key: index[key] for key in index.files}
 
-    objects = set()
-    for recipe_info in recipes.values():
-        objects.update(recipe_info["in"].keys())
-        objects.update(recipe_info["out"].keys())
+def apply_book(data, book):
+    # Fills in the recipe book part of a request from the index. Recipes only get
+    # the fields read when reporting, the item matrix comes from the index.
+    machine_types = book["machines"].tolist()
+    data["machines"] = {machine_type: {"crafts_per_min": crafts, "power_kw": power_kw, "footprint": footprint}
+                        for machine_type, crafts, power_kw, footprint
+                        in zip(machine_types, book["crafts_per_min"].tolist(), book["power_kw"].tolist(), book["footprint"].tolist())}
+    data["recipes"] = {recipe: {"machine": machine_types[m], "time_s": time_s}
+                       for recipe, m, time_s in zip(book["recipes"].tolist(), book["recipe_machine"].tolist(), book["time_s"].tolist())}
+    if "modules" not in data:
+        data["modules"] = {machine_type: {"prod": prod, "speed": speed}
+                           for machine_type, prod, speed in zip(machine_types, book["module_prod"].tolist(), book["module_speed"].tolist())}
 
-    intermediates = objects - set(supplies) - set([target])
-    I = len(intermediates)
+def create_book_item_matrix(book, machines, objects):
+    # create_item_matrix from the index, machines must have the modules applied
+    machine_types = book["machines"].tolist()
+    prod = np.array([machines[machine_type]["prod"] for machine_type in machine_types])[book["recipe_machine"]]
+    speed = np.array([machines[machine_type]["speed"] for machine_type in machine_types])[book["recipe_machine"]]
+    eff_craft_per_min = book["crafts_per_min"][book["recipe_machine"]] * (1 + speed) * 60 / book["time_s"]
 
-    machines = data["machines"]
+    objects.update((obj, i) for i, obj in enumerate(book["objects"].tolist()))
+    rows = np.concatenate([book["in_rows"], book["out_rows"]])
+    cols = np.concatenate([book["in_cols"], book["out_cols"]])
+    vals = np.concatenate([-book["in_counts"] * eff_craft_per_min[book["in_cols"]],
+                           book["out_counts"] * (eff_craft_per_min * (1 + prod))[book["out_cols"]]])
+    return coo_matrix((vals, (rows, cols)), shape=(len(objects), len(book["recipes"]))).tocsr()
+
+def get_item_matrix(data, book=None):
+    apply_modules(data["machines"], data["modules"])
+    objects = {}
+    if book is None:
+        return create_item_matrix(data["recipes"], data["machines"], objects), objects
+    return create_book_item_matrix(book, data["machines"], objects), objects
+
+def create_machine_matrix(recipes, machine_types):
+    machine_index = {machine_type: i for i, machine_type in enumerate(machine_types)}
+    rows = [machine_index[recipe_info["machine"]] for recipe_info in recipes.values()]
+    cols = np.arange(len(recipes))
+    return csr_matrix((np.ones(len(recipes)), (rows, cols)), shape=(len(machine_types), len(recipes)))
+
+def apply_modules(machines, modules):
     for machine in machines:
         prod = 0.0
         speed = 0.0
@@ -62,122 +149,897 @@ def create_equations(data):
         machines[machine]["prod"] = prod
         machines[machine]["speed"] = speed
 
+def get_targets(data):
+    # Target items and rates, data["target"] (the reference target) last
+    target = data["target"]["item"]
+    targets = {obj: rate for obj, rate in data.get("targets", {}).items() if obj != target}
+    targets[target] = data["target"]["rate_per_min"]
+    return targets
+
+def get_equation_items(objects, supplies, targets):
+    # Objects of the rows of A_eq: the intermediates, then the targets
+    excluded = set(supplies) | set(targets)
+    return [obj for obj in objects if obj not in excluded] + list(targets)
+
+def create_equations(data, item_matrix=None):
+    # Process the data
+    recipes = data["recipes"]
+    R = len(recipes)
+    machine_types = list(data["machines"].keys())
+    supplies = list(data["limits"]["raw_supply_per_min"].keys())
+    target = data["target"]["item"]
+    target_rate = data["target"]["rate_per_min"]
+    targets = get_targets(data)
+
+    machines = data["machines"]
+    apply_modules(machines, data["modules"])
+
+    # The item matrix only depends on recipes, machines and modules, so it can be
+    # shared between requests which only change the target or the limits
+    if item_matrix is None:
+        objects = {}
+        P = create_item_matrix(recipes, machines, objects)
+    else:
+        P, objects = item_matrix
+        objects = dict(objects)
+    for obj in supplies + list(targets):
+        objects.setdefault(obj, len(objects))
+    if P.shape[0] < len(objects):
+        P = P.copy()
+        P.resize((len(objects), R))
+
+    eq_items = get_equation_items(objects, supplies, targets)
+    I = len(eq_items) - len(targets)
+
     # Setup the equations
     # Steady state for intermediates and target
-    A_eq = np.zeros((I+1, R))
-    b_eq = np.zeros(I+1)
-    
-    for i, obj in enumerate(intermediates):
-        A_eq[i,:] = get_obj_eqn(obj, recipes, machines)
-        b_eq[i] = 0.0
-
-    A_eq[I,:] = get_obj_eqn(target, recipes, machines)
-    b_eq[I] = target_rate
+    A_eq = P[[objects[obj] for obj in eq_items]]
+    if len(targets) > 1:
+        # The other targets are kept in proportion to the last one, so its rate
+        # (b_eq[-1]) still scales the whole plan
+        ref_rate = targets[target]
+        ratios = np.array([rate / ref_rate if ref_rate else 0.0 for rate in targets.values()])[:-1]
+        proportional = A_eq[I:-1] - csr_matrix(ratios[:, None]) @ A_eq[-1:]
+        A_eq = vstack([A_eq[:I], proportional, A_eq[-1:]], format="csr")
+    b_eq = np.zeros(len(eq_items))
+    b_eq[-1] = target_rate
 
     # Upper bounds for supplies and machines
-    A_ub = np.zeros((S+M, R))
-    b_ub = np.zeros(S+M)
+    A_ub = vstack([-P[[objects[obj] for obj in supplies]], create_machine_matrix(recipes, machine_types)], format="csr")
+    b_ub = np.array([data["limits"]["raw_supply_per_min"][obj] for obj in supplies]
+                    + [data["limits"]["max_machines"][machine_type] for machine_type in machine_types], dtype=float)
 
-    for i, obj in enumerate(supplies):
-        A_ub[i,:] = -get_obj_eqn(obj, recipes, machines)
-        b_ub[i] = data["limits"]["raw_supply_per_min"][obj]
+    # Objective to minimize, total machines by default
+    c = create_objective(data.get("objective", "machines"), A_ub, recipes, machines, supplies, data.get("raw_weights"))
 
-    for i, machine_type in enumerate(machine_types):
-        for j, recipe_info in enumerate(recipes.values()):
-            if recipe_info["machine"] == machine_type:
-                A_ub[S+i, j] = 1.0
-        b_ub[S+i] = data["limits"]["max_machines"][machine_type]
+    return c, A_ub, b_ub, A_eq, b_eq, recipes, supplies, machines, machine_types
 
-    # Objective to minimize total machines
-    c = np.ones(R)
+def create_objective_vectors(A_ub, recipes, machines, supplies, raw_weights=None):
+    # Cost per machine of every recipe: one machine, the power draw and tile footprint
+    # of its machine (0 if not given), and its weighted raw consumption
+    raw_weights = raw_weights or {}
+    machine_of = [recipe_info["machine"] for recipe_info in recipes.values()]
+    weights = np.array([raw_weights.get(obj, 1.0) for obj in supplies], dtype=float)
+    vectors = {}
+    vectors["machines"] = np.ones(len(recipes))
+    vectors["power"] = np.array([machines[machine].get("power_kw", 0.0) for machine in machine_of], dtype=float)
+    vectors["footprint"] = np.array([machines[machine].get("footprint", 0.0) for machine in machine_of], dtype=float)
+    vectors["raw"] = A_ub[:len(supplies)].T @ weights
+    return vectors
 
-    return c, A_ub, b_ub, A_eq, b_eq, recipes, supplies, machines, machine_types
+def combine_objective(objective, vectors):
+    # A name or a {name: weight} dict of a weighted sum
+    if isinstance(objective, str):
+        objective = {objective: 1.0}
+    for name in objective:
+        if name not in vectors:
+            raise ValueError(f"Unknown objective {name}, expected one of {', '.join(vectors)}")
+    return sum(weight * vectors[name] for name, weight in objective.items())
 
-def is_feasible(c, A_ub, b_ub, A_eq, b_eq, target):
-    b_eq[-1] = target
-    result = linprog(c, A_ub, b_ub, A_eq, b_eq, method="highs-ds", options=linprog_options)
-    return result.success
+def create_objective(objective, A_ub, recipes, machines, supplies, raw_weights=None):
+    # A list is lexicographic, the first entry is the objective of the plain solve
+    if isinstance(objective, list):
+        objective = objective[0]
+    if objective == "machines":
+        return np.ones(len(recipes))
+    return combine_objective(objective, create_objective_vectors(A_ub, recipes, machines, supplies, raw_weights))
+
+def get_sparse_entries(A):
+    # entries(k) gives the (index, value) pairs of column k (CSC) or row k (CSR).
+    # Plain lists, element access on numpy arrays is slow in the presolve loops.
+    indptr, indices, data = A.indptr.tolist(), A.indices.tolist(), A.data.tolist()
+    def entries(k):
+        return zip(indices[indptr[k]:indptr[k+1]], data[indptr[k]:indptr[k+1]])
+    return entries
+
+def presolve(c, A_ub, b_ub, A_eq, b_eq):
+    # Drops the recipes the target cannot depend on and substitutes out forced
+    # chains. A recipe is kept if it produces the target, an object a kept recipe
+    # consumes, or a supply a kept recipe consumes. Every solution of the reduced
+    # problem is a solution of the full one, optimality is checked afterwards by
+    # price_pruned_recipes.
+    R = len(c)
+    target_row = A_eq.shape[0] - 1
+    eq_col, eq_row = get_sparse_entries(A_eq.tocsc()), get_sparse_entries(A_eq.tocsr())
+    ub_col, ub_row = get_sparse_entries(A_ub.tocsc()), get_sparse_entries(A_ub.tocsr())
+
+    keep = [False] * R
+    seen_eq = set()
+    seen_ub = set()
+    queue = [j for j, v in eq_row(target_row) if v > 0]
+    while queue:
+        j = queue.pop()
+        if keep[j]:
+            continue
+        keep[j] = True
+        # Producers of the objects j consumes
+        for row, v in eq_col(j):
+            if v >= 0 or row in seen_eq:
+                continue
+            seen_eq.add(row)
+            queue.extend(j2 for j2, v2 in eq_row(row) if v2 > 0 and not keep[j2])
+        # Producers of the supplies j consumes
+        for row, v in ub_col(j):
+            if v <= 0 or row in seen_ub:
+                continue
+            seen_ub.add(row)
+            queue.extend(j2 for j2, v2 in ub_row(row) if v2 < 0 and not keep[j2])
+
+    keep = np.array(keep, dtype=bool)
+    if not keep.any():
+        keep[:] = True
+
+    # Columns as dicts of (kind, row) -> coefficient for the chain substitution
+    kept = np.flatnonzero(keep).tolist()
+    cols = {}
+    eq_cols = [set() for _ in range(A_eq.shape[0])]
+    cost = {}
+    for j in kept:
+        col = {("eq", row): v for row, v in eq_col(j)}
+        col.update({("ub", row): v for row, v in ub_col(j)})
+        for kind, row in col:
+            if kind == "eq":
+                eq_cols[row].add(j)
+        cols[j] = col
+        cost[j] = float(c[j])
+
+    # Forced chain: an intermediate made by exactly one recipe p and used by exactly
+    # one recipe q forces x_p = k x_q, so p is folded into q's column
+    substitutions = []
+    folded = []
+    b_eq_list = b_eq.tolist()
+    candidates = [row for row in range(target_row) if len(eq_cols[row]) == 2 and b_eq_list[row] == 0]
+    while candidates:
+        row = candidates.pop()
+        if len(eq_cols[row]) != 2:
+            continue
+        j1, j2 = eq_cols[row]
+        v1, v2 = cols[j1][("eq", row)], cols[j2][("eq", row)]
+        if v1 * v2 >= 0:
+            continue
+        p, q = (j1, j2) if v1 > 0 else (j2, j1)
+        k = -cols[q][("eq", row)] / cols[p][("eq", row)]
+        folded.append((dict(cols[p]), cost[p]))
+
+        for key, v in cols.pop(p).items():
+            if key[0] == "eq":
+                eq_cols[key[1]].discard(p)
+            if key == ("eq", row):
+                cols[q].pop(key)
+                eq_cols[row].discard(q)
+                continue
+            cols[q][key] = cols[q].get(key, 0.0) + k * v
+            if key[0] == "eq":
+                eq_cols[key[1]].add(q)
+                if len(eq_cols[key[1]]) == 2 and key[1] != target_row and b_eq_list[key[1]] == 0:
+                    candidates.append(key[1])
+        cost[q] += k * cost.pop(p)
+        substitutions.append((p, q, k, row))
+
+    # Assemble the reduced problem, the target row stays last
+    kept = sorted(cols)
+    eq_rows = [row for row in range(A_eq.shape[0]) if eq_cols[row] or b_eq[row] != 0 or row == target_row]
+    ub_used = set(key[1] for col in cols.values() for key in col if key[0] == "ub")
+    ub_rows = [row for row in range(A_ub.shape[0]) if row in ub_used or b_ub[row] < 0]
+    eq_pos = {row: i for i, row in enumerate(eq_rows)}
+    ub_pos = {row: i for i, row in enumerate(ub_rows)}
+
+    eq_entries = [(eq_pos[row], i, v) for i, j in enumerate(kept) for (kind, row), v in cols[j].items() if kind == "eq"]
+    ub_entries = [(ub_pos[row], i, v) for i, j in enumerate(kept) for (kind, row), v in cols[j].items() if kind == "ub"]
+    A_eq_r = coo_matrix(([v for _, _, v in eq_entries], ([r for r, _, _ in eq_entries], [i for _, i, _ in eq_entries])),
+                        shape=(len(eq_rows), len(kept))).tocsr()
+    A_ub_r = coo_matrix(([v for _, _, v in ub_entries], ([r for r, _, _ in ub_entries], [i for _, i, _ in ub_entries])),
+                        shape=(len(ub_rows), len(kept))).tocsr()
+
+    info = {
+        "cols": np.array(kept, dtype=int), "eq_rows": eq_rows, "ub_rows": ub_rows, "ub_pos": ub_pos,
+        "pruned_cols": np.flatnonzero(~keep), "substitutions": substitutions, "folded": folded, "R": R,
+        "presolved": True,
+    }
+    return np.array([cost[j] for j in kept]), A_ub_r, b_ub[ub_rows].copy(), A_eq_r, b_eq[eq_rows].copy(), info
+
+def expand_solution(x_r, info):
+    x = np.zeros(info["R"])
+    x[info["cols"]] = x_r
+    for p, q, k, _ in reversed(info["substitutions"]):
+        x[p] = k * x[q]
+    return x
+
+def no_presolve(c, A_ub, b_ub, A_eq, b_eq):
+    # Same shape as presolve, keeping everything
+    R = len(c)
+    info = {
+        "cols": np.arange(R), "eq_rows": list(range(len(b_eq))), "ub_rows": list(range(len(b_ub))),
+        "ub_pos": {row: row for row in range(len(b_ub))}, "pruned_cols": [], "substitutions": [], "folded": [], "R": R,
+        "presolved": False,
+    }
+    return c, A_ub, b_ub.copy(), A_eq, b_eq.copy(), info
+
+def price_pruned_recipes(c, A_ub, A_eq, result, info):
+    # Extends the duals of the reduced solve to the full problem: dropped rows get 0
+    # and a collapsed row the value at which its folded recipe prices at zero, which
+    # keeps the reduced cost of the recipe it was folded into. If no recipe then has
+    # a negative reduced cost the reduced optimum is optimal for the full problem.
+    y_eq = np.zeros(A_eq.shape[0])
+    y_eq[info["eq_rows"]] = result.eqlin.marginals
+    y_ub = np.zeros(A_ub.shape[0])
+    y_ub[info["ub_rows"]] = result.ineqlin.marginals
+    for (_, _, _, row), (col, cost) in zip(reversed(info["substitutions"]), reversed(info["folded"])):
+        y = {"eq": y_eq, "ub": y_ub}
+        rest = sum(v * y[kind][r] for (kind, r), v in col.items() if (kind, r) != ("eq", row))
+        y_eq[row] = (cost - rest) / col[("eq", row)]
+    reduced_costs = c - A_eq.T @ y_eq - A_ub.T @ y_ub
+    return reduced_costs.min(initial=0.0) >= -FEAS_TOL
+
+def get_presolve_report(info, recipes, eq_items, constraint_names):
+    recipe_names = list(recipes)
+    collapsed_rows = set(row for _, _, _, row in info["substitutions"])
+    kept_eq_rows = set(info["eq_rows"])
+    kept_ub_rows = set(info["ub_rows"])
+    report = {}
+    report["recipes"] = info["R"]
+    report["recipes_kept"] = len(info["cols"])
+    report["pruned_recipes"] = [recipe_names[j] for j in info["pruned_cols"]]
+    report["pruned_items"] = [obj for row, obj in enumerate(eq_items) if row not in kept_eq_rows and row not in collapsed_rows]
+    report["pruned_constraints"] = [name for row, name in enumerate(constraint_names) if row not in kept_ub_rows]
+    report["collapsed"] = [{"recipe": recipe_names[p], "into": recipe_names[q], "ratio": k, "item": eq_items[row]}
+                           for p, q, k, row in info["substitutions"]]
+    return report
+
+def solve_max_target(A_ub, b_ub, A_eq):
+    # Treat the target rate t as a variable and maximize it in a single solve
+    R = A_ub.shape[1]
+    c_t = np.zeros(R+1)
+    c_t[R] = -1.0
 
-def binary_search_target(c, A_ub, b_ub, A_eq, b_eq):
-    target = TOL
-    while is_feasible(c, A_ub, b_ub, A_eq, b_eq, target*2):
-        target *= 2
-    step = target / 2
-    while step >= TOL:
-        if is_feasible(c, A_ub, b_ub, A_eq, b_eq, target + step)    :
-            target += step
-        step /= 2
-    return target
+    t_col = csr_matrix(([-1.0], ([A_eq.shape[0]-1], [0])), shape=(A_eq.shape[0], 1))
+    A_ub_t = hstack([A_ub, csr_matrix((A_ub.shape[0], 1))], format="csr")
+    A_eq_t = hstack([A_eq, t_col], format="csr")
+    b_eq_t = np.zeros(A_eq.shape[0])
+
+    result = linprog(c_t, A_ub_t, b_ub, A_eq_t, b_eq_t, method="highs-ds", options=linprog_options)
+    # The duals of A_ub give the target gained per extra unit of each supply or machine
+    return result.x[R], -result.ineqlin.marginals
 
 
 def create_solution(x, A_ub, recipes, supplies, machines, machine_types):
     S = len(supplies)
+    usage = A_ub @ x
     soln = {}
     soln["status"] = "ok"
 
     soln["per_recipe_crafts_per_min"] = {}
     for i, obj in enumerate(recipes):
         recipe_info = recipes[obj]
-        machine_type = recipe_info["machine"]
-        prod = machines[machine_type].get("prod", 0.0)
-        speed = machines[machine_type].get("speed", 0.0)
-        time_s = recipe_info["time_s"]
-        eff_craft_per_min = machines[machine_type]["crafts_per_min"] * (1 + speed) * 60 / time_s * (1 + prod)
-        rate = eff_craft_per_min * x[i]
+        prod = machines[recipe_info["machine"]].get("prod", 0.0)
+        rate = get_eff_craft_per_min(recipe_info, machines) * (1 + prod) * x[i]
         soln["per_recipe_crafts_per_min"][obj] = rate
 
     soln["per_machine_counts"] = {}
     for i, machine_type in enumerate(machine_types):
-        count = A_ub[S+i:S+i+1,:] @ x
-        soln["per_machine_counts"][machine_type] = count[0]
+        soln["per_machine_counts"][machine_type] = usage[S+i]
 
     soln["raw_consumption_per_min"] = {}
     for i, obj in enumerate(supplies):
-        rate = A_ub[i,:] @ x
-        soln["raw_consumption_per_min"][obj] = rate
+        soln["raw_consumption_per_min"][obj] = usage[i]
+
+    return soln
 
+def get_bottleneck_hint(gains, supplies, machine_types, module_kinds=()):
+    # Every supply or machine whose shadow price is positive, most valuable first
+    names = get_constraint_names(supplies, machine_types, module_kinds)
+    order = [k for k in np.argsort(-gains, kind="stable") if gains[k] > TOL]
+    bottleneck_hint = [names[k] for k in order]
+
+    S = len(supplies)
+    M = len(machine_types)
+    bottleneck_gain = []
+    for k in order:
+        if k < S:
+            bottleneck_gain.append(f"+1/min {supplies[k]} gives +{gains[k]:.6g}/min")
+        elif k < S + M:
+            bottleneck_gain.append(f"+1 {machine_types[k-S]} gives +{gains[k]:.6g}/min")
+        else:
+            bottleneck_gain.append(f"+1 {module_kinds[k-S-M]} module gives +{gains[k]:.6g}/min")
+    return bottleneck_hint, bottleneck_gain
+
+def create_max_feasible_solution(A_ub, b_ub, A_eq, supplies, machine_types, module_kinds=()):
+    soln = {}
+    soln["status"] = "infeasible"
+    max_target, gains = solve_max_target(A_ub, b_ub, A_eq)
+    soln["max_feasible_target_per_min"] = max_target
+    soln["bottleneck_hint"], soln["bottleneck_gain"] = get_bottleneck_hint(gains, supplies, machine_types, module_kinds)
     return soln
 
-def get_bottleneck_hint(c, A_ub, b_ub, A_eq, b_eq, target):
-    # Create max possible
+def get_constraint_names(supplies, machine_types, module_kinds=()):
+    # Names of the rows of A_ub, in the form used by the bottleneck hints
+    return ([f"{supply} supply" for supply in supplies] + [f"{machine} cap" for machine in machine_types]
+            + [f"{kind} modules supply" for kind in module_kinds])
+
+def solve_at_target(c, A_ub, b_ub, A_eq, b_eq, target):
     b_eq[-1] = target
     result = linprog(c, A_ub, b_ub, A_eq, b_eq, method="highs-ds", options=linprog_options)
-    x = result.x
-    soln = create_solution(result.x, A_ub, recipes, supplies, machines, machine_types)
-    bottleneck_hint = []
-
-    # Check machine and supply at full capacity 
-    for machine in machine_types:
-        used_count = soln["per_machine_counts"][machine]
-        max_count = data["limits"]["max_machines"][machine]
-        if abs(used_count - max_count) < 1e-3:
-            bottleneck_hint.append(f"{machine} cap")
-
-    for supply in supplies:
-        used_rate = soln["raw_consumption_per_min"][supply]
-        max_rate = data["limits"]["raw_supply_per_min"][supply]
-        if abs(used_rate - max_rate) < 1e-3:
-            bottleneck_hint.append(f"{supply} supply")
-
-    return bottleneck_hint
-
-def create_max_feasible_solution(c, A_ub, b_ub, A_eq, b_eq):
+    # Minimum machines and its derivative with respect to the target rate
+    return target, result.fun, result.eqlin.marginals[-1], result.ineqlin.marginals
+
+def get_throughput_curve(c, A_ub, b_ub, A_eq, b_eq, supplies, machine_types):
+    # The minimum machine count f(t) is convex and piecewise linear in the target t,
+    # and the dual of the target row is a subgradient of f. Between two solved points
+    # the tangents cross at a single t: if f(t) lies on them it is a breakpoint,
+    # otherwise t is solved and both halves are searched. Each breakpoint costs at
+    # most two solves, plus one solve per segment to read its binding constraints.
+    names = get_constraint_names(supplies, machine_types)
+    max_target, gains = solve_max_target(A_ub, b_ub, A_eq)
+    max_target = max(0.0, max_target)
+
+    # A target which cannot be produced leaves the single point t = 0
+    points = [solve_at_target(c, A_ub, b_ub, A_eq, b_eq, 0.0)]
+    if max_target > TOL:
+        points.append(solve_at_target(c, A_ub, b_ub, A_eq, b_eq, max_target))
+    stack = [(points[0], points[1])] if len(points) > 1 else []
+    while stack and len(points) < CURVE_MAX_SOLVES:
+        (t_l, f_l, g_l, _), (t_r, f_r, g_r, _) = stack.pop()
+        if g_r - g_l <= CURVE_TOL * max(1.0, abs(g_r)):
+            continue
+        t_m = (f_r - f_l + g_l * t_l - g_r * t_r) / (g_l - g_r)
+        if not t_l + TOL < t_m < t_r - TOL:
+            continue
+        mid = solve_at_target(c, A_ub, b_ub, A_eq, b_eq, t_m)
+        points.append(mid)
+        if mid[1] - (f_l + g_l * (t_m - t_l)) > CURVE_TOL * max(1.0, abs(mid[1])):
+            stack.append((mid, (t_r, f_r, g_r, None)))
+            stack.append(((t_l, f_l, g_l, None), mid))
+
+    # Keep the points where the slope changes
+    points = sorted(points, key=lambda point: point[0])
+    breakpoints = [points[0]]
+    for k in range(1, len(points) - 1):
+        (t_a, f_a), (t_b, f_b), (t_c, f_c) = breakpoints[-1][:2], points[k][:2], points[k+1][:2]
+        chord = f_a + (f_c - f_a) * (t_b - t_a) / (t_c - t_a)
+        if abs(f_b - chord) > CURVE_TOL * max(1.0, abs(f_b)):
+            breakpoints.append(points[k])
+    if len(points) > 1:
+        breakpoints.append(points[-1])
+
+    segments = []
+    for (t_a, f_a, _, _), (t_b, f_b, _, _) in zip(breakpoints, breakpoints[1:]):
+        if t_b - t_a <= TOL:
+            continue
+        marginals = solve_at_target(c, A_ub, b_ub, A_eq, b_eq, (t_a + t_b) / 2)[3]
+        active = [k for k in np.argsort(marginals, kind="stable") if marginals[k] < -TOL]
+        segments.append({
+            "from_target_per_min": t_a,
+            "to_target_per_min": t_b,
+            "machines_per_target": (f_b - f_a) / (t_b - t_a),
+            "bottleneck": [names[k] for k in active],
+        })
+
+    return max_target, gains, [(t, f) for t, f, _, _ in breakpoints], segments
+
+def create_curve_solution(c, A_ub, b_ub, A_eq, b_eq, recipes, supplies, machines, machine_types):
+    soln = {}
+    soln["status"] = "ok"
+    max_target, gains, breakpoints, segments = get_throughput_curve(c, A_ub, b_ub, A_eq, b_eq, supplies, machine_types)
+    soln["max_feasible_target_per_min"] = max_target
+    soln["breakpoints"] = [{"target_per_min": t, "machines": f} for t, f in breakpoints]
+    soln["segments"] = segments
+    soln["bottleneck_hint"], soln["bottleneck_gain"] = get_bottleneck_hint(gains, supplies, machine_types)
+    return soln
+
+def round_machine_counts(c, A_ub, b_ub, A_eq, b_eq, S):
+    # Rounds the machines of every recipe up. If that breaks a machine cap, the cap
+    # is lowered by the excess and the LP solved again, which moves production to
+    # recipes with spare fractional machines.
+    # Also returns the objective of the first LP, a lower bound of the integer
+    # problem, which the repaired LPs are not.
+    b_ub = b_ub.copy()
+    lp_value = None
+    for _ in range(ROUND_MAX_REPAIRS):
+        result = linprog(c, A_ub, b_ub, A_eq, b_eq, method="highs-ds", options=linprog_options)
+        if not result.success:
+            return None, lp_value
+        if lp_value is None:
+            lp_value = result.fun
+        x = np.clip(result.x, 0.0, None)
+        n = np.ceil(x - FEAS_TOL) + 0.0
+        excess = A_ub[S:] @ n - b_ub[S:]
+        if np.all(excess <= FEAS_TOL):
+            return (x, n), lp_value
+        b_ub[S:] -= np.clip(excess, 0.0, None)
+    return None, lp_value
+
+def get_integer_model(A_ub, b_ub, A_eq, b_eq, S, t_col=False):
+    # Variables [x, n] (and t): crafting machines x run within the whole machines
+    # n of their recipe, the machine caps apply to n and the supplies to x
+    R = A_ub.shape[1]
+    zeros = lambda rows: csr_matrix((rows, R))
+    extra = [csr_matrix(([-1.0], ([A_eq.shape[0]-1], [0])), shape=(A_eq.shape[0], 1))] if t_col else []
+    pad = lambda rows: [csr_matrix((rows, 1))] if t_col else []
+    constraints = [
+        LinearConstraint(hstack([A_eq, zeros(A_eq.shape[0])] + extra, format="csr"), b_eq, b_eq),
+        LinearConstraint(hstack([A_ub[:S], zeros(S)] + pad(S), format="csr"), -np.inf, b_ub[:S]),
+        LinearConstraint(hstack([zeros(A_ub.shape[0]-S), A_ub[S:]] + pad(A_ub.shape[0]-S), format="csr"), -np.inf, b_ub[S:]),
+        LinearConstraint(hstack([identity(R), -identity(R)] + pad(R), format="csr"), -np.inf, 0.0),
+    ]
+    integrality = np.concatenate([np.zeros(R), np.ones(R), np.zeros(int(t_col))])
+    return constraints, integrality
+
+def solve_integer_milp(c, A_ub, b_ub, A_eq, b_eq, S, time_limit):
+    R = len(c)
+    constraints, integrality = get_integer_model(A_ub, b_ub, A_eq, b_eq, S)
+    # HiGHS' MIP solver can print debug lines to stdout
+    with quiet_stdout():
+        result = milp(np.concatenate([np.zeros(R), c]), constraints=constraints, integrality=integrality,
+                      bounds=Bounds(0.0, np.inf), options={"time_limit": time_limit})
+    if result.x is None:
+        return None, result
+    return (np.clip(result.x[:R], 0.0, None), np.round(result.x[R:]) + 0.0), result
+
+def solve_integer_max_target(A_ub, b_ub, A_eq, S, time_limit):
+    R = A_ub.shape[1]
+    constraints, integrality = get_integer_model(A_ub, b_ub, A_eq, np.zeros(A_eq.shape[0]), S, t_col=True)
+    c_t = np.zeros(2*R+1)
+    c_t[-1] = -1.0
+    with quiet_stdout():
+        result = milp(c_t, constraints=constraints, integrality=integrality, bounds=Bounds(0.0, np.inf),
+                      options={"time_limit": time_limit})
+    if result.x is None:
+        return None
+    return np.clip(result.x[:R], 0.0, None), np.round(result.x[R:2*R]) + 0.0, result.x[-1]
+
+def create_integer_solution(c, A_ub, b_ub, A_eq, b_eq, recipes, supplies, machines, machine_types, method="round", time_limit=MILP_TIME_LIMIT_S):
+    # Whole machines per recipe. "round" rounds the LP solution up and repairs the
+    # machine caps, "milp" solves the exact MILP within time_limit seconds; round
+    # falls back to the MILP when the repair fails.
+    if method not in ("round", "milp"):
+        raise ValueError(f"Unknown integer method {method}, expected one of round, milp")
+    S = len(supplies)
+    # With integer coefficients the objective of whole machines is an integer too,
+    # so its bounds can be rounded up
+    integral = np.all(c == np.round(c))
+    round_up = lambda value: np.ceil(value - FEAS_TOL) if integral else value
+    counts, lp_value = round_machine_counts(c, A_ub, b_ub, A_eq, b_eq, S)
+    bound = None if lp_value is None else round_up(lp_value)
+    if method == "milp" or counts is None:
+        method = "milp"
+        milp_counts, result = solve_integer_milp(c, A_ub, b_ub, A_eq, b_eq, S, time_limit)
+        if result.mip_dual_bound is not None and np.isfinite(result.mip_dual_bound):
+            bound = max(bound or 0.0, round_up(result.mip_dual_bound))
+        if milp_counts is not None and (counts is None or c @ milp_counts[1] <= c @ counts[1]):
+            counts = milp_counts
+        elif counts is not None:
+            method = "round"
+
+    if counts is None:
+        return create_integer_max_feasible_solution(A_ub, b_ub, A_eq, supplies, machine_types, time_limit)
+
+    x, n = counts
+    soln = create_solution(x, A_ub, recipes, supplies, machines, machine_types)
+    machine_counts = A_ub[S:] @ n
+    for i, machine_type in enumerate(machine_types):
+        soln["per_machine_counts"][machine_type] = machine_counts[i]
+    soln["per_recipe_machine_counts"] = dict(zip(recipes, n))
+    total = c @ n
+    # Solver tolerances may put the bound a hair above the value found
+    bound = min(bound, total) if bound is not None else None
+    soln["integer"] = {
+        "method": method,
+        "objective_value": total,
+        "lower_bound": bound,
+        "optimality_gap": (total - bound) / total if total > 0 else 0.0,
+    }
+    return soln
+
+def create_integer_max_feasible_solution(A_ub, b_ub, A_eq, supplies, machine_types, time_limit):
+    # Maximum target reachable with whole machines, and the caps and supplies used up there
+    S = len(supplies)
+    max_solution = solve_integer_max_target(A_ub, b_ub, A_eq, S, time_limit)
+    if max_solution is None:
+        return {"status": "error", "message": "No integer solution found within the time limit"}
+    x, n, max_target = max_solution
+    usage = np.concatenate([A_ub[:S] @ x, A_ub[S:] @ n])
+    limits = np.concatenate([b_ub[:S], np.floor(b_ub[S:] + FEAS_TOL)])
+    names = get_constraint_names(supplies, machine_types)
     soln = {}
     soln["status"] = "infeasible"
-    max_target = binary_search_target(c, A_ub, b_ub, A_eq, b_eq)
     soln["max_feasible_target_per_min"] = max_target
-    soln["bottleneck_hint"] = get_bottleneck_hint(c, A_ub, b_ub, A_eq, b_eq, max_target)
+    soln["bottleneck_hint"] = [names[k] for k in range(len(names)) if usage[k] >= limits[k] - FEAS_TOL * max(1.0, abs(limits[k]))]
     return soln
 
-if __name__=="__main__":
-    data = scan_input()
-    c, A_ub, b_ub, A_eq, b_eq, recipes, supplies, machines, machine_types = create_equations(data)
+def create_lexicographic_solution(objectives, c, A_ub, b_ub, A_eq, b_eq, recipes, supplies, machines, machine_types, raw_weights=None):
+    # Minimizes the objectives in order, each one within LEX_TOL of its optimum
+    # while the next is minimized
+    vectors = create_objective_vectors(A_ub, recipes, machines, supplies, raw_weights)
+    A_ub_k, b_ub_k = A_ub, b_ub
+    for objective in objectives:
+        c_k = combine_objective(objective, vectors)
+        result = linprog(c_k, A_ub_k, b_ub_k, A_eq, b_eq, method="highs-ds", options=linprog_options)
+        if not result.success:
+            # Only the first stage can fail, later stages keep a feasible point
+            return create_max_feasible_solution(A_ub, b_ub, A_eq, supplies, machine_types)
+        A_ub_k = vstack([A_ub_k, csr_matrix(c_k)], format="csr")
+        b_ub_k = np.append(b_ub_k, result.fun + LEX_TOL * max(1.0, abs(result.fun)))
+
+    x = np.clip(result.x, 0.0, None)
+    soln = create_solution(x, A_ub, recipes, supplies, machines, machine_types)
+    soln["objective_values"] = {name: vector @ x for name, vector in vectors.items()}
+    return soln
+
+def create_tradeoff_solution(data, objectives=None, book=None):
+    # Payoff table: each objective minimized on its own in one session, with the
+    # value of every objective at each optimum
+    session = FactorySession(data, book)
+    objectives = objectives or ["machines", "power", "footprint", "raw"]
+    tradeoff = []
+    for objective in objectives:
+        session.set_objective(objective)
+        soln = session.solve()
+        if soln["status"] != "ok":
+            return soln
+        tradeoff.append({"objective": objective, "values": session.objective_values()})
+    return {"status": "ok", "tradeoff": tradeoff}
+
+def create_module_equations(data, book=None):
+    # With a limited module supply every recipe whose machine has modules gets one
+    # column per loadout: no modules, a full set of prod modules and a full set of
+    # speed modules. data["modules"] then gives the effect of each full set and its
+    # "slots". The loadouts share the machine caps and the modules of each kind
+    # are a row of A_ub, so the allocation is part of the same LP and stays linear
+    # in the number of recipes.
+    modules = data["modules"]
+    loadouts = {"plain": {}}
+    for kind in MODULE_KINDS:
+        loadouts[kind] = {machine: {kind: spec[kind]} for machine, spec in modules.items() if spec.get(kind, 0.0) != 0.0}
+
+    blocks = []
+    for loadout, loadout_modules in loadouts.items():
+        loadout_data = dict(data, machines=copy.deepcopy(data["machines"]), modules=loadout_modules)
+        (c, A_ub, b_ub, A_eq, b_eq, recipes, supplies,
+         machines, machine_types) = create_equations(loadout_data, get_item_matrix(loadout_data, book))
+        cols = [j for j, recipe_info in enumerate(recipes.values()) if loadout == "plain" or recipe_info["machine"] in loadout_modules]
+        rates = [get_eff_craft_per_min(recipe_info, machines) * (1 + machines[recipe_info["machine"]]["prod"]) for recipe_info in recipes.values()]
+        slots = [modules.get(recipe_info["machine"], {}).get("slots", 1) for recipe_info in recipes.values()]
+        blocks.append((loadout, cols, c[cols], A_ub[:, cols], A_eq[:, cols], np.array(rates)[cols], np.array(slots, dtype=float)[cols]))
+
+    supply = data["module_supply"]
+    kinds = [kind for kind in MODULE_KINDS if kind in supply]
+    module_rows = [np.concatenate([block[6] if block[0] == kind else np.zeros(len(block[1])) for block in blocks]) for kind in kinds]
+
+    columns = {}
+    columns["recipe"] = np.concatenate([block[1] for block in blocks]).astype(int)
+    columns["loadout"] = [block[0] for block in blocks for _ in block[1]]
+    columns["crafts_per_min"] = np.concatenate([block[5] for block in blocks])
+    columns["modules"] = np.concatenate([block[6] * (block[0] != "plain") for block in blocks])
+    c = np.concatenate([block[2] for block in blocks])
+    A_ub = vstack([hstack([block[3] for block in blocks]), csr_matrix(np.reshape(module_rows, (len(kinds), len(c))))], format="csr")
+    b_ub = np.concatenate([b_ub, [supply[kind] for kind in kinds]])
+    A_eq = hstack([block[4] for block in blocks], format="csr")
+    return c, A_ub, b_ub, A_eq, b_eq, recipes, supplies, machine_types, kinds, columns
+
+def create_module_solution(data, book=None):
+    c, A_ub, b_ub, A_eq, b_eq, recipes, supplies, machine_types, kinds, columns = create_module_equations(data, book)
+    result = linprog(c, A_ub, b_ub, A_eq, b_eq, method="highs-ds", options=linprog_options)
+    if not result.success:
+        return create_max_feasible_solution(A_ub, b_ub, A_eq, supplies, machine_types, kinds)
+
+    S = len(supplies)
+    M = len(machine_types)
+    x = np.clip(result.x, 0.0, None)
+    usage = A_ub @ x
+    soln = {}
+    soln["status"] = "ok"
+    crafts = np.bincount(columns["recipe"], weights=columns["crafts_per_min"] * x, minlength=len(recipes))
+    soln["per_recipe_crafts_per_min"] = dict(zip(recipes, crafts))
+    soln["per_machine_counts"] = dict(zip(machine_types, usage[S:S+M]))
+    soln["raw_consumption_per_min"] = dict(zip(supplies, usage[:S]))
+
+    # Machines and modules of each loadout, for the recipes which have modules
+    recipe_names = list(recipes)
+    soln["per_recipe_modules"] = {}
+    soln["module_usage"] = {kind: 0.0 for kind in MODULE_KINDS}
+    for j, loadout, modules, x_k in zip(columns["recipe"], columns["loadout"], columns["modules"], x):
+        if loadout == "plain":
+            continue
+        allocation = soln["per_recipe_modules"].setdefault(recipe_names[j], {f"{kind}_{unit}": 0.0 for kind in MODULE_KINDS for unit in ("machines", "modules")})
+        allocation[f"{loadout}_machines"] += x_k
+        allocation[f"{loadout}_modules"] += modules * x_k
+        soln["module_usage"][loadout] += modules * x_k
+    return soln
+
+class FactorySession:
+    # Keeps the model built by create_equations between what-if queries. Rate and
+    # limit changes only touch b_eq/b_ub, so the optimal basis of the previous solve
+    # (positive columns and rows with a non-zero dual) is tried first: if it is
+    # still primal feasible for the new right hand side it is still optimal, since
+    # c and A are unchanged. Otherwise, and after module changes, linprog is rerun.
+    # The solves run on the presolved problem (lp), results use the full one.
+    def __init__(self, data, book=None):
+        self.data = data
+        self.book = book
+        self.x = None
+        self.warm_starts = 0
+        self.cold_solves = 0
+        self.item_matrix = None
+        self.build()
+
+    def build(self):
+        if self.item_matrix is None:
+            self.item_matrix = get_item_matrix(self.data, self.book)
+        (self.c, self.A_ub, self.b_ub, self.A_eq, self.b_eq, self.recipes,
+         self.supplies, self.machines, self.machine_types) = create_equations(self.data, self.item_matrix)
 
-    if is_feasible(c, A_ub, b_ub, A_eq, b_eq, data["target"]["rate_per_min"]):
+        self.prepare()
+
+    def prepare(self):
+        prepare = presolve if self.data.get("presolve", True) else no_presolve
+        *self.lp, self.presolve_info = prepare(self.c, self.A_ub, self.b_ub, self.A_eq, self.b_eq)
+        self.basis = None
+
+    def presolve_report(self):
+        eq_items = get_equation_items(self.item_matrix[1], self.supplies, get_targets(self.data))
+        return get_presolve_report(self.presolve_info, self.recipes, eq_items, get_constraint_names(self.supplies, self.machine_types))
+
+    def set_target_rate(self, rate):
+        self.data["target"]["rate_per_min"] = rate
+
+    def set_target_item(self, item):
+        # Reselects the rows of A_eq from the shared item matrix
+        self.data["target"]["item"] = item
+        self.build()
+
+    def set_limit(self, row, value):
+        self.b_ub[row] = value
+        if row in self.presolve_info["ub_pos"]:
+            self.lp[2][self.presolve_info["ub_pos"][row]] = value
+
+    def set_supply_limit(self, supply, rate):
+        self.data["limits"]["raw_supply_per_min"][supply] = rate
+        if supply not in self.supplies:
+            self.build()
+            return
+        self.set_limit(self.supplies.index(supply), rate)
+
+    def set_machine_limit(self, machine, count):
+        self.data["limits"]["max_machines"][machine] = count
+        self.set_limit(len(self.supplies) + self.machine_types.index(machine), count)
+
+    def set_objective(self, objective):
+        # Only c changes, the previous basis may no longer be optimal
+        self.data["objective"] = objective
+        self.c = create_objective(objective, self.A_ub, self.recipes, self.machines, self.supplies, self.data.get("raw_weights"))
+        self.prepare()
+
+    def set_modules(self, machine, prod=0.0, speed=0.0):
+        self.data["modules"][machine] = {"prod": prod, "speed": speed}
+        self.item_matrix = None
+        self.build()
+
+    def warm_start(self):
+        if self.basis is None:
+            return None
+        c, A_ub, b_ub, A_eq, b_eq = self.lp
+        cols, rows = self.basis
+        A = vstack([A_eq[:, cols], A_ub[rows][:, cols]], format="csr")
+        b = np.concatenate([b_eq, b_ub[rows]])
+        tol = FEAS_TOL * max(1.0, np.abs(b).max(initial=0.0))
+
+        # Rows which do not touch the basis must already be satisfied
+        used = np.diff(A.indptr) > 0
+        if np.any(np.abs(b[~used]) > tol):
+            return None
+        A = A[used].toarray()
+        b = b[used]
+        x_cols = np.linalg.lstsq(A, b, rcond=None)[0]
+
+        if np.abs(A @ x_cols - b).max(initial=0.0) > tol or np.any(x_cols < -tol):
+            return None
+        x = np.zeros(len(c))
+        x[cols] = np.clip(x_cols, 0.0, None)
+        if np.any(A_ub @ x > b_ub + tol):
+            return None
+        return x
+
+    def solve(self):
+        c, A_ub, b_ub, A_eq, b_eq = self.lp
+        b_eq[-1] = self.data["target"]["rate_per_min"]
+        x = self.warm_start()
+        if x is not None:
+            self.warm_starts += 1
+            return self.create_solution(expand_solution(x, self.presolve_info))
+
+        self.cold_solves += 1
         result = linprog(c, A_ub, b_ub, A_eq, b_eq, method="highs-ds", options=linprog_options)
-        x = result.x
-        soln = create_solution(result.x, A_ub, recipes, supplies, machines, machine_types)
+        if self.presolve_info["presolved"]:
+            if not result.success:
+                # The pruned recipes may still be needed, e.g. to consume a byproduct
+                return self.solve_full()
+            if not price_pruned_recipes(self.c, self.A_ub, self.A_eq, result, self.presolve_info):
+                # A pruned recipe would lower the machine count, keep the full problem
+                *self.lp, self.presolve_info = no_presolve(self.c, self.A_ub, self.b_ub, self.A_eq, self.b_eq)
+                return self.solve()
+        if not result.success:
+            self.basis = None
+            return create_max_feasible_solution(A_ub, b_ub, A_eq, self.supplies, self.machine_types)
+
+        cols = np.flatnonzero(result.x > TOL)
+        rows = np.flatnonzero(np.abs(result.ineqlin.marginals) > TOL)
+        self.basis = (cols, rows)
+        return self.create_solution(expand_solution(result.x, self.presolve_info))
+
+    def solve_full(self):
+        self.basis = None
+        self.b_eq[-1] = self.data["target"]["rate_per_min"]
+        result = linprog(self.c, self.A_ub, self.b_ub, self.A_eq, self.b_eq, method="highs-ds", options=linprog_options)
+        if not result.success:
+            return create_max_feasible_solution(self.A_ub, self.b_ub, self.A_eq, self.supplies, self.machine_types)
+        return self.create_solution(result.x)
+
+    def create_solution(self, x):
+        # x of the full problem, kept for objective_values
+        self.x = x
+        return create_solution(x, self.A_ub, self.recipes, self.supplies, self.machines, self.machine_types)
+
+    def objective_values(self):
+        vectors = create_objective_vectors(self.A_ub, self.recipes, self.machines, self.supplies, self.data.get("raw_weights"))
+        return {name: vector @ self.x for name, vector in vectors.items()}
+
+def solve_batch_points(data, points, book=None):
+    session = FactorySession(data, book)
+    solns = []
+    for item, rate in points:
+        if item != session.data["target"]["item"]:
+            session.set_target_item(item)
+        session.set_target_rate(rate)
+        solns.append(session.solve())
+    return solns
+
+def solve_batch(data, items=None, rates=None, workers=0, book=None):
+    # Every (item, rate) point in one session, so the matrices are built once and
+    # consecutive rates reuse the previous basis. With workers > 1 the points are
+    # split into contiguous chunks solved by a pool of processes.
+    data = copy.deepcopy(data)
+    items = items or [data["target"]["item"]]
+    rates = rates or [data["target"]["rate_per_min"]]
+    points = [(item, rate) for item in items for rate in rates]
+
+    if workers > 1:
+        chunks = [chunk for chunk in np.array_split(np.arange(len(points)), workers) if len(chunk)]
+        with ProcessPoolExecutor(workers) as pool:
+            results = pool.map(solve_batch_points, [data]*len(chunks), [[points[i] for i in chunk] for chunk in chunks], [book]*len(chunks))
+            solns = [soln for chunk_solns in results for soln in chunk_solns]
     else:
-        soln = create_max_feasible_solution(c, A_ub, b_ub, A_eq, b_eq)
-    
-    print_soln(soln)
+        solns = solve_batch_points(data, points, book)
+
+    recipes = list(data["recipes"])
+    machine_types = list(data["machines"])
+    supplies = list(data["limits"]["raw_supply_per_min"])
+    batch = {}
+    batch["items"] = [item for item, _ in points]
+    batch["rates"] = np.array([rate for _, rate in points], dtype=float)
+    batch["status"] = [soln["status"] for soln in solns]
+    batch["max_feasible_target_per_min"] = [soln.get("max_feasible_target_per_min") for soln in solns]
+    batch["recipes"] = recipes
+    batch["machines"] = machine_types
+    batch["supplies"] = supplies
+
+    # Infeasible points are left at zero
+    batch["per_recipe_crafts_per_min"] = np.zeros((len(points), len(recipes)))
+    batch["per_machine_counts"] = np.zeros((len(points), len(machine_types)))
+    batch["raw_consumption_per_min"] = np.zeros((len(points), len(supplies)))
+    for i, soln in enumerate(solns):
+        if soln["status"] == "ok":
+            batch["per_recipe_crafts_per_min"][i] = list(soln["per_recipe_crafts_per_min"].values())
+            batch["per_machine_counts"][i] = list(soln["per_machine_counts"].values())
+            batch["raw_consumption_per_min"][i] = list(soln["raw_consumption_per_min"].values())
+    return batch
+
+def solve_plan(data, book=None):
+    if "module_supply" in data:
+        return create_module_solution(data, book)
+    if data.get("tradeoff"):
+        return create_tradeoff_solution(data, None if data["tradeoff"] is True else data["tradeoff"], book)
+    objective = data.get("objective")
+    if isinstance(objective, list) and len(objective) > 1:
+        return create_lexicographic_solution(objective, *create_equations(data, get_item_matrix(data, book)), data.get("raw_weights"))
+    if data.get("integer"):
+        method = "round" if data["integer"] is True else data["integer"]
+        return create_integer_solution(*create_equations(data, get_item_matrix(data, book)), method, data.get("time_limit_s", MILP_TIME_LIMIT_S))
+    if data.get("curve"):
+        return create_curve_solution(*create_equations(data, get_item_matrix(data, book)))
+    session = FactorySession(data, book)
+    soln = session.solve()
+    if objective is not None and soln["status"] == "ok":
+        soln["objective_values"] = session.objective_values()
+    if data.get("presolve_report"):
+        soln["presolve_report"] = session.presolve_report()
+    return soln
+
+def solve(data, book=None):
+    if book is not None:
+        apply_book(data, book)
+    if "targets" in data:
+        # The target with the highest rate is the reference the others are scaled with
+        item, rate = max(data["targets"].items(), key=lambda target: target[1])
+        data["target"] = {"item": item, "rate_per_min": rate}
+    if "batch" in data:
+        batch = data["batch"]
+        result = solve_batch(data, batch.get("items"), batch.get("rates"), batch.get("workers", 0), book)
+        return {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in result.items()}
+
+    soln = solve_plan(data, book)
+    if "targets" in data and soln["status"] == "infeasible":
+        # All targets scaled by the same factor as the reference one
+        scale = soln["max_feasible_target_per_min"] / data["target"]["rate_per_min"] if data["target"]["rate_per_min"] else 0.0
+        soln["max_feasible_targets_per_min"] = {obj: scale * rate for obj, rate in data["targets"].items()}
+    return soln
+
+def respond(data, cache=None, indent=4, book=None):
+    if cache is None:
+        return format_soln(solve(data, book), indent=indent)
+
+    # Key before solving, create_equations writes the module values into data
+    options = (indent,) if book is None else (indent, book["digest"].item())
+    key = cache.key(data, *options)
+    output = cache.get(key)
+    if output is None:
+        output = format_soln(solve(data, book), indent=indent)
+        cache.put(key, output)
+    return output
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compile", metavar="PATH", help="write the index of the recipe book read from stdin (machines, recipes, modules) to this .npz file")
+    parser.add_argument("--book", metavar="PATH", help="take machines, recipes and default modules from an index written by --compile")
+    parser.add_argument("--compact", action="store_true", help="print the result on a single line, as --serve does")
+    parser.add_argument("--serve", action="store_true", help="read one JSON request per line from stdin and write one response per line")
+    parser.add_argument("--socket", help="serve the same line protocol on this Unix socket instead of stdin")
+    parser.add_argument("--cache", action="store_true", help="reuse the output of identical requests")
+    parser.add_argument("--cache-dir", help="also keep cached outputs in this directory across runs")
+    parser.add_argument("--cache-max-bytes", type=int, default=64 * 2**20, help="size limit of the cache directory")
+    parser.add_argument("--cache-stats", action="store_true", help="print cache hit/miss counters to stderr on exit")
+    args = parser.parse_args()
+
+    if args.compile:
+        print_soln(save_book(scan_input(), args.compile))
+        exit()
+    book = load_book(args.book) if args.book else None
+
+    cache = None
+    if args.cache or args.cache_dir:
+        cache = ResultCache("factory", CACHE_VERSION, args.cache_dir, max_bytes=args.cache_max_bytes)
+
+    try:
+        if args.socket:
+            serve_socket(lambda data: respond(data, cache, indent=None, book=book), args.socket)
+        elif args.serve:
+            serve_lines(lambda data: respond(data, cache, indent=None, book=book), sys.stdin, sys.stdout)
+        else:
+            data = scan_input()
+            indent = None if args.compact else 4
+            if cache is None:
+                write_soln(solve(data, book), sys.stdout, indent)
+            else:
+                print(respond(data, cache, indent, book))
+    finally:
+        if cache is not None and args.cache_stats:
+            print(json.dumps(cache.stats()), file=sys.stderr)
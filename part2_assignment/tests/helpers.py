@@ -25,9 +25,9 @@ def compare_json(a, b):
     else:
         assert a == b
 
-def run_program(file_path, input_json):
+def run_program(file_path, input_json, args=()):
     result = subprocess.run(
-        ["python3", file_path],
+        ["python3", file_path, *args],
         input=json.dumps(input_json),
         capture_output=True,
         text=True
@@ -37,3 +37,31 @@ def run_program(file_path, input_json):
         raise RuntimeError(f"Solver crashed for {input_json}:\n{result.stderr}")
     
     return json.loads(result.stdout)
+
+def run_cached(file_path, input_jsons, args=()):
+    # One request per line, returns the outputs and the counters --cache-stats
+    # prints to stderr on exit
+    result = subprocess.run(
+        ["python3", file_path, "--cache-stats", *args],
+        input="".join(json.dumps(input_json) + "\n" for input_json in input_jsons),
+        capture_output=True,
+        text=True
+    )
+
+    if result.returncode != 0:
+        raise RuntimeError(f"Solver crashed:\n{result.stderr}")
+
+    return [json.loads(line) for line in result.stdout.splitlines()], json.loads(result.stderr.splitlines()[-1])
+
+def run_server(file_path, input_jsons):
+    result = subprocess.run(
+        ["python3", file_path, "--serve"],
+        input="".join(json.dumps(input_json) + "\n" for input_json in input_jsons),
+        capture_output=True,
+        text=True
+    )
+
+    if result.returncode != 0:
+        raise RuntimeError(f"Server crashed:\n{result.stderr}")
+
+    return [json.loads(line) for line in result.stdout.splitlines()]
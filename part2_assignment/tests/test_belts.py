@@ -1,5 +1,7 @@
+import json
+import subprocess
 import pytest
-from helpers import compare_json, run_program
+from helpers import compare_json, run_cached, run_program
 
 TEST_CASES = [
     pytest.param(
@@ -192,6 +194,140 @@ TEST_CASES = [
           ]
         },
         id="case_6_feasible_with_cycle_and_fixed_flow"
+    ),
+    pytest.param(
+        {
+          "nodes": {
+            "a": {"cap": 100},
+            "a_in": {},
+            "t": {}
+          },
+          "edges": [
+            {"from": "s1", "to": "a_in", "lo": 0, "hi": 100},
+            {"from": "a_in", "to": "a", "lo": 0, "hi": 100},
+            {"from": "a", "to": "t", "lo": 0, "hi": 100}
+          ],
+          "sources": {
+            "s1": 50
+          },
+          "sink": "t"
+        },
+        {
+          "status": "ok",
+          "max_flow_per_min": 50,
+          "flows": [
+            {"from": "s1", "to": "a_in", "flow": 50},
+            {"from": "a_in", "to": "a", "flow": 50},
+            {"from": "a", "to": "t", "flow": 50}
+          ]
+        },
+        id="case_7_node_names_with_split_suffixes"
+    ),
+    pytest.param(
+        {
+          "nodes": {
+            "a": {"cap": 12.5},
+            "t": {}
+          },
+          "edges": [
+            {"from": "s1", "to": "a", "lo": 0, "hi": 7.5},
+            {"from": "s2", "to": "a", "lo": 0.25, "hi": 7.5},
+            {"from": "a", "to": "t", "lo": 2.5, "hi": 100}
+          ],
+          "sources": {
+            "s1": 7.5,
+            "s2": 4.75
+          },
+          "sink": "t"
+        },
+        {
+          "status": "ok",
+          "max_flow_per_min": 12.25,
+          "flows": [
+            {"from": "s1", "to": "a", "flow": 7.5},
+            {"from": "s2", "to": "a", "flow": 4.75},
+            {"from": "a", "to": "t", "flow": 12.25}
+          ]
+        },
+        id="case_8_fractional_rates"
+    ),
+    pytest.param(
+        {
+          "nodes": {
+            "a": {},
+            "b": {},
+            "c": {}
+          },
+          "edges": [
+            {"from": "s1", "to": "a", "lo": 0, "hi": 100},
+            {"from": "a", "to": "b", "lo": 0, "hi": 60},
+            {"from": "a", "to": "c", "lo": 0, "hi": 30}
+          ],
+          "sources": {"s1": 80},
+          "sinks": {"b": 50, "c": 30}
+        },
+        {
+          "status": "ok",
+          "max_flow_per_min": 80,
+          "flows": [
+            {"from": "s1", "to": "a", "flow": 80},
+            {"from": "a", "to": "b", "flow": 50},
+            {"from": "a", "to": "c", "flow": 30}
+          ]
+        },
+        id="case_9_feasible_multi_sink"
+    ),
+    pytest.param(
+        {
+          "nodes": {
+            "a": {},
+            "b": {},
+            "c": {}
+          },
+          "edges": [
+            {"from": "s1", "to": "a", "lo": 0, "hi": 100},
+            {"from": "a", "to": "b", "lo": 0, "hi": 60},
+            {"from": "a", "to": "c", "lo": 0, "hi": 30}
+          ],
+          "sources": {"s1": 80},
+          "sinks": {"b": 40, "c": 40}
+        },
+        {
+          "status": "infeasible",
+          "cut_reachable": ["a", "b", "s1"],
+          "deficit": {
+            "demand_balance": 10,
+            "tight_nodes": [],
+            "tight_edges": [
+              {"from": "a", "to": "c"}
+            ],
+            "sink_shortfall": {"b": 0, "c": 10}
+          }
+        },
+        id="case_10_infeasible_multi_sink_shortfall"
+    ),
+    pytest.param(
+        {
+          "nodes": {
+            "a": {"cap": 5e9},
+            "t": {}
+          },
+          "edges": [
+            {"from": "s1", "to": "a", "lo": 0, "hi": 1e19},
+            {"from": "a", "to": "t", "lo": 0.5, "hi": 3e9}
+          ],
+          "sources": {"s1": 40.5},
+          "sink": "t"
+        },
+        {
+          "status": "ok",
+          "max_flow_per_min": 40.5,
+          "flows": [
+            {"from": "s1", "to": "a", "flow": 40.5},
+            {"from": "a", "to": "t", "flow": 40.5}
+          ]
+        },
+        id="case_11_caps_beyond_int32"
     )
 ]
 
@@ -199,3 +335,214 @@ TEST_CASES = [
 def test_belt(input_json, output_json):
     result = run_program("belts/main.py", input_json)
     compare_json(result, output_json)
+
+def test_belt_cache(tmp_path):
+    # A different --scale is a different key, the same one is read from disk
+    input_json, output_json = TEST_CASES[0].values
+    args = ["--cache-dir", str(tmp_path), "--compact"]
+    for run_args, expected in [
+        (args, {"hits": 0, "disk_hits": 0, "misses": 1}),
+        (args + ["--scale", "10"], {"hits": 0, "disk_hits": 0, "misses": 1}),
+        (args, {"hits": 1, "disk_hits": 1, "misses": 0}),
+    ]:
+        results, stats = run_cached("belts/main.py", [input_json], run_args)
+        compare_json(results, [output_json])
+        assert stats == expected
+    assert len(list(tmp_path.glob("*.json"))) == 2
+
+def test_belt_compact():
+    input_json, output_json = TEST_CASES[1].values
+    result = subprocess.run(["python3", "belts/main.py", "--compact"], input=json.dumps(input_json), capture_output=True, text=True)
+    assert result.stdout.count("\n") == 1
+    compare_json(json.loads(result.stdout), output_json)
+
+def test_belt_overflow():
+    # Only totals beyond int32 are an error, and --scale is only suggested above 1
+    input_json = {"nodes": {}, "edges": [{"from": "s", "to": "t", "lo": 0, "hi": 1e19}], "sources": {"s": 3e9}, "sink": "t"}
+    result = subprocess.run(["python3", "belts/main.py"], input=json.dumps(input_json), capture_output=True, text=True)
+    assert result.stdout == "Rates do not fit the int32 capacities of maximum_flow\n"
+    input_json["sources"]["s"] = 3e8
+    result = subprocess.run(["python3", "belts/main.py", "--scale", "100"], input=json.dumps(input_json), capture_output=True, text=True)
+    assert result.stdout == "Rates scaled by 100 do not fit the int32 capacities of maximum_flow, pass a smaller --scale\n"
+
+    # A session re-clamps caps when an edit raises the supply
+    input_json["sources"]["s"] = 5
+    lines = [input_json, {"op": "set_supply", "source": "s", "rate": 50}]
+    result = subprocess.run(["python3", "belts/main.py", "--session"], input="".join(json.dumps(line) + "\n" for line in lines), capture_output=True, text=True)
+    expected = [
+        {"status": "ok", "max_flow_per_min": rate, "flows": [{"from": "s", "to": "t", "flow": rate}]}
+        for rate in (5, 50)
+    ]
+    compare_json([json.loads(line) for line in result.stdout.splitlines()], expected)
+
+def test_belt_session():
+    # One response per line: the network, then the network after each edit so far
+    input_json, output_json = TEST_CASES[1].values
+    lines = [
+        input_json,
+        {"op": "set_edge", "from": "a", "to": "b", "hi": 100},
+        [{"op": "set_supply", "source": "s1", "rate": 60}, {"op": "set_node_cap", "node": "b", "cap": 50}],
+        {"op": "add_edge", "from": "a", "to": "t", "hi": 10},
+        {"op": "remove_edge", "from": "x", "to": "y"},
+        {"op": "remove_edge", "from": "a", "to": "t"},
+    ]
+    cut = {
+        "status": "infeasible",
+        "cut_reachable": ["a", "b", "s1"],
+        "deficit": {"demand_balance": 10, "tight_nodes": ["b"], "tight_edges": []},
+    }
+    expected = [
+        output_json,
+        {
+            "status": "ok",
+            "max_flow_per_min": 100,
+            "flows": [
+                {"from": "s1", "to": "a", "flow": 100},
+                {"from": "a", "to": "b", "flow": 100},
+                {"from": "b", "to": "t", "flow": 100},
+            ],
+        },
+        cut,
+        {
+            "status": "ok",
+            "max_flow_per_min": 60,
+            "flows": [
+                {"from": "s1", "to": "a", "flow": 60},
+                {"from": "a", "to": "b", "flow": 50},
+                {"from": "a", "to": "t", "flow": 10},
+                {"from": "b", "to": "t", "flow": 50},
+            ],
+        },
+        {"status": "error", "message": "ValueError: No edge from x to y"},
+        cut,
+    ]
+    result = subprocess.run(
+        ["python3", "belts/main.py", "--session"],
+        input="".join(json.dumps(line) + "\n" for line in lines),
+        capture_output=True,
+        text=True,
+    )
+    compare_json([json.loads(line) for line in result.stdout.splitlines()], expected)
+
+MODE_CASES = [
+    pytest.param(
+        dict(TEST_CASES[1].values[0], mode="max_flow"),
+        {
+          "status": "ok",
+          "max_flow_per_min": 70,
+          "flows": [
+            {"from": "s1", "to": "a", "flow": 70},
+            {"from": "a", "to": "b", "flow": 70},
+            {"from": "b", "to": "t", "flow": 70}
+          ]
+        },
+        id="max_flow_below_supply"
+    ),
+    pytest.param(
+        {
+          "nodes": {"a": {}, "b": {}, "t": {}},
+          "edges": [
+            {"from": "s1", "to": "a", "lo": 0, "hi": 100},
+            {"from": "a", "to": "b", "lo": 20, "hi": 40},
+            {"from": "a", "to": "t", "lo": 0, "hi": 10},
+            {"from": "b", "to": "t", "lo": 0, "hi": 100}
+          ],
+          "sources": {"s1": 100},
+          "sink": "t",
+          "mode": "max_flow"
+        },
+        {
+          "status": "ok",
+          "max_flow_per_min": 50,
+          "flows": [
+            {"from": "s1", "to": "a", "flow": 50},
+            {"from": "a", "to": "b", "flow": 40},
+            {"from": "a", "to": "t", "flow": 10},
+            {"from": "b", "to": "t", "flow": 40}
+          ]
+        },
+        id="max_flow_with_lower_bounds"
+    ),
+    pytest.param(
+        {
+          "nodes": {"a": {}, "b": {}, "c": {}, "t": {}},
+          "edges": [
+            {"from": "s1", "to": "a", "lo": 0, "hi": 100},
+            {"from": "a", "to": "b", "lo": 0, "hi": 100, "cost": 1},
+            {"from": "a", "to": "c", "lo": 25, "hi": 100, "cost": 5},
+            {"from": "b", "to": "t", "lo": 0, "hi": 30},
+            {"from": "c", "to": "t", "lo": 0, "hi": 100}
+          ],
+          "sources": {"s1": 50},
+          "sink": "t",
+          "mode": "min_cost"
+        },
+        {
+          "status": "ok",
+          "max_flow_per_min": 50,
+          "total_cost": 150.0,
+          "flows": [
+            {"from": "s1", "to": "a", "flow": 50},
+            {"from": "a", "to": "b", "flow": 25},
+            {"from": "a", "to": "c", "flow": 25},
+            {"from": "b", "to": "t", "flow": 25},
+            {"from": "c", "to": "t", "flow": 25}
+          ]
+        },
+        id="min_cost_with_lower_bounds"
+    ),
+]
+
+@pytest.mark.parametrize("input_json, output_json", MODE_CASES)
+def test_belt_modes(input_json, output_json):
+    compare_json(run_program("belts/main.py", input_json), output_json)
+
+def test_belt_all_cuts():
+    # s1 -> a is in every min cut, s2 -> b and b -> c are interchangeable
+    input_json = {
+        "nodes": {"a": {}, "b": {}, "c": {}, "t": {}},
+        "edges": [
+            {"from": "s1", "to": "a", "lo": 0, "hi": 40},
+            {"from": "a", "to": "t", "lo": 0, "hi": 100},
+            {"from": "s2", "to": "b", "lo": 0, "hi": 50},
+            {"from": "b", "to": "c", "lo": 0, "hi": 50},
+            {"from": "c", "to": "t", "lo": 0, "hi": 100}
+        ],
+        "sources": {"s1": 100, "s2": 100},
+        "sink": "t",
+        "certificate": "all_cuts"
+    }
+    output_json = {
+        "status": "infeasible",
+        "cut_reachable": ["s1", "s2"],
+        "deficit": {
+            "demand_balance": 110,
+            "tight_nodes": [],
+            "tight_edges": [{"from": "s1", "to": "a"}, {"from": "s2", "to": "b"}]
+        },
+        "min_cuts": {
+            "cut_reachable_max": ["b", "s1", "s2"],
+            "in_every_cut": {"tight_nodes": [], "tight_edges": [{"from": "s1", "to": "a"}]},
+            "in_some_cut": {"tight_nodes": [], "tight_edges": [{"from": "b", "to": "c"}, {"from": "s2", "to": "b"}]}
+        }
+    }
+    compare_json(run_program("belts/main.py", input_json), output_json)
+
+def to_ndjson(input_json):
+    # Header line, then the edges as rows with every other one as an edge object
+    header = {key: value for key, value in input_json.items() if key != "edges"}
+    lines = [json.dumps(dict(header, edge_count=len(input_json["edges"])))]
+    for i, edge in enumerate(input_json["edges"]):
+        row = [edge["from"], edge["to"], edge["lo"], edge["hi"]] + ([edge["cost"]] if "cost" in edge else [])
+        lines.append(json.dumps(edge if i % 2 else row))
+    return "\n".join(lines) + "\n"
+
+@pytest.mark.parametrize("input_json, output_json", TEST_CASES + MODE_CASES[2:])
+def test_belt_ndjson(input_json, output_json):
+    result = subprocess.run(
+        ["python3", "belts/main.py", "--ndjson"],
+        input=to_ndjson(input_json),
+        capture_output=True,
+        text=True,
+    )
+    compare_json(json.loads(result.stdout), output_json)
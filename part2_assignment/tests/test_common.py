@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import ResultCache
+
+def test_cache_lru():
+    cache = ResultCache("test", 1, max_entries=2)
+    a, b, c = (cache.key({"request": i}) for i in range(3))
+    cache.put(a, "A")
+    cache.put(b, "B")
+    assert cache.get(a) == "A"
+    # b is now the least recently used entry
+    cache.put(c, "C")
+    assert cache.get(b) is None
+    assert cache.get(a) == "A" and cache.get(c) == "C"
+    assert cache.stats() == {"hits": 3, "disk_hits": 0, "misses": 1}
+
+def test_cache_versions():
+    assert ResultCache("test", 1).key({}) != ResultCache("test", 2).key({})
+
+def test_cache_eviction(tmp_path):
+    directory = str(tmp_path)
+    cache = ResultCache("test", 1, directory, max_bytes=250)
+    a, b, c = (cache.key({"request": i}) for i in range(3))
+    cache.put(a, "a" * 100)
+    cache.put(b, "b" * 100)
+    for i, key in enumerate((a, b)):
+        os.utime(os.path.join(directory, key + ".json"), (1000 + i, 1000 + i))
+
+    # A disk hit of a new cache marks a as recently used, so b is evicted
+    cache = ResultCache("test", 1, directory, max_bytes=250)
+    assert cache.disk_bytes == 200
+    assert cache.get(a) == "a" * 100
+    cache.put(c, "c" * 100)
+    assert sorted(os.listdir(directory)) == sorted([a + ".json", c + ".json"])
+    assert cache.disk_bytes == 200
+    assert cache.stats() == {"hits": 1, "disk_hits": 1, "misses": 0}
@@ -1,5 +1,8 @@
+import copy
+import json
+import subprocess
 import pytest
-from helpers import compare_json, run_program
+from helpers import compare_json, run_cached, run_program, run_server
 
 TEST_CASES = [
     pytest.param(
@@ -217,7 +220,8 @@ TEST_CASES = [
         {
             "status": "infeasible",
             "max_feasible_target_per_min": 1366.2,
-            "bottleneck_hint": ["assembler_1 cap"]
+            "bottleneck_hint": ["assembler_1 cap"],
+            "bottleneck_gain": ["+1 assembler_1 gives +4554/min"]
         },
         id="case_3_infeasible_machine_cap_correct_logic"
     ),
@@ -292,7 +296,8 @@ TEST_CASES = [
         {
             "status": "infeasible",
             "max_feasible_target_per_min": 1760.0,
-            "bottleneck_hint": ["copper_ore supply"]
+            "bottleneck_hint": ["copper_ore supply"],
+            "bottleneck_gain": ["+1/min copper_ore gives +0.44/min"]
         },
         id="case_4_infeasible_raw_supply_correct_logic"
     ),
@@ -475,3 +480,281 @@ def test_factory(input_json, output_json):
     result = run_program("factory/main.py", input_json)
     print(output_json, result)
     compare_json(result, output_json)
+
+def test_factory_serve():
+    inputs = [input_json for input_json, _ in (case.values for case in TEST_CASES)]
+    results = run_server("factory/main.py", inputs)
+    assert len(results) == len(TEST_CASES)
+    for result, case in zip(results, TEST_CASES):
+        compare_json(result, case.values[1])
+
+def test_factory_cache(tmp_path):
+    # The second run is served from the directory, a repeated line under --serve
+    # from memory
+    input_json, output_json = TEST_CASES[0].values
+    args = ["--cache-dir", str(tmp_path), "--compact"]
+    results, stats = run_cached("factory/main.py", [input_json], args)
+    compare_json(results, [output_json])
+    assert stats == {"hits": 0, "disk_hits": 0, "misses": 1}
+    results, stats = run_cached("factory/main.py", [input_json], args)
+    compare_json(results, [output_json])
+    assert stats == {"hits": 1, "disk_hits": 1, "misses": 0}
+    assert len(list(tmp_path.glob("*.json"))) == 1
+
+    results, stats = run_cached("factory/main.py", [input_json, input_json], ["--serve", "--cache"])
+    compare_json(results, [output_json, output_json])
+    assert stats == {"hits": 1, "disk_hits": 0, "misses": 1}
+
+def test_factory_batch():
+    input_json = copy.deepcopy(TEST_CASES[1].values[0])
+    input_json["batch"] = {"items": ["target", "plate"], "rates": [100, 10000]}
+    output_json = {
+        "items": ["target", "target", "plate", "plate"],
+        "rates": [100.0, 10000.0, 100.0, 10000.0],
+        "status": ["ok", "infeasible", "ok", "infeasible"],
+        "max_feasible_target_per_min": [None, 1000.0, None, 1000.0],
+        "recipes": ["raw_to_plate", "plate_to_target"],
+        "machines": ["assembler"],
+        "supplies": ["raw"],
+        "per_recipe_crafts_per_min": [[100.0, 100.0], [0.0, 0.0], [100.0, 0.0], [0.0, 0.0]],
+        "per_machine_counts": [[0.083333333], [0.0], [0.027777778], [0.0]],
+        "raw_consumption_per_min": [[100.0], [0.0], [100.0], [0.0]]
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+def test_factory_presolve_report():
+    input_json = copy.deepcopy(TEST_CASES[1].values[0])
+    input_json["target"]["item"] = "plate"
+    input_json["presolve_report"] = True
+    output_json = {
+        "status": "ok",
+        "per_recipe_crafts_per_min": {"raw_to_plate": 100.0, "plate_to_target": 0.0},
+        "per_machine_counts": {"assembler": 0.027777778},
+        "raw_consumption_per_min": {"raw": 100.0},
+        "presolve_report": {
+            "recipes": 2,
+            "recipes_kept": 1,
+            "pruned_recipes": ["plate_to_target"],
+            "pruned_items": ["target"],
+            "pruned_constraints": [],
+            "collapsed": []
+        }
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+def test_factory_book(tmp_path):
+    input_json = copy.deepcopy(TEST_CASES[2].values[0])
+    output_json = TEST_CASES[2].values[1]
+    book_path = str(tmp_path / "book.npz")
+    book = {key: input_json.pop(key) for key in ("machines", "recipes", "modules")}
+    summary = run_program("factory/main.py", book, ["--compile", book_path])
+    assert summary["status"] == "ok" and summary["recipes"] == len(book["recipes"])
+    compare_json(run_program("factory/main.py", input_json, ["--book", book_path]), output_json)
+
+    # The machine costs of the book drive the objective
+    book = {
+        "machines": {"a": {"crafts_per_min": 60, "power_kw": 100}, "b": {"crafts_per_min": 60, "power_kw": 1}},
+        "recipes": {
+            "x_a": {"machine": "a", "time_s": 1, "in": {"ore": 1}, "out": {"x": 2}},
+            "x_b": {"machine": "b", "time_s": 1, "in": {"ore": 2}, "out": {"x": 1}}
+        }
+    }
+    run_program("factory/main.py", book, ["--compile", book_path])
+    input_json = {
+        "target": {"item": "x", "rate_per_min": 60},
+        "limits": {"raw_supply_per_min": {"ore": 1000}, "max_machines": {"a": 10, "b": 10}},
+        "objective": "power"
+    }
+    output_json = {
+        "status": "ok",
+        "per_recipe_crafts_per_min": {"x_a": 0.0, "x_b": 60.0},
+        "per_machine_counts": {"a": 0.0, "b": 0.016666667},
+        "raw_consumption_per_min": {"ore": 120.0},
+        "objective_values": {"machines": 0.016666667, "power": 0.016666667, "footprint": 0.0, "raw": 120.0}
+    }
+    compare_json(run_program("factory/main.py", input_json, ["--book", book_path]), output_json)
+
+def test_factory_integer():
+    input_json = copy.deepcopy(TEST_CASES[0].values[0])
+    input_json["integer"] = "milp"
+    output_json = {
+        "status": "ok",
+        "per_recipe_crafts_per_min": {"iron_plate": 1636.363636364, "copper_plate": 4909.090909091, "green_circuit": 1800.0},
+        "per_machine_counts": {"assembler_1": 1.0, "chemical": 6.0},
+        "raw_consumption_per_min": {"iron_ore": 1363.636363636, "copper_ore": 4090.909090909},
+        "per_recipe_machine_counts": {"iron_plate": 2.0, "copper_plate": 4.0, "green_circuit": 1.0},
+        "integer": {"method": "milp", "objective_value": 7.0, "lower_bound": 7.0, "optimality_gap": 0.0}
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+    # Fractional power per machine, the bound is not rounded up past the optimum
+    input_json["machines"]["assembler_1"]["power_kw"] = 150.5
+    input_json["machines"]["chemical"]["power_kw"] = 90
+    input_json["objective"] = "power"
+    output_json["integer"] = {"method": "milp", "objective_value": 690.5, "lower_bound": 690.5, "optimality_gap": 0.0}
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+    # 0.3 assemblers round down to none
+    input_json = copy.deepcopy(TEST_CASES[2].values[0])
+    input_json["integer"] = True
+    output_json = {"status": "infeasible", "max_feasible_target_per_min": 0.0, "bottleneck_hint": ["assembler_1 cap"]}
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+    input_json["integer"] = "exact"
+    output_json = {"status": "error", "message": "ValueError: Unknown integer method exact, expected one of round, milp"}
+    compare_json(run_server("factory/main.py", [input_json]), [output_json])
+
+def test_factory_objectives():
+    input_json = copy.deepcopy(TEST_CASES[4].values[0])
+    input_json["machines"]["fast_m"]["power_kw"] = 300
+    input_json["machines"]["slow_m"]["power_kw"] = 50
+    input_json["raw_weights"] = {"raw_A": 2}
+    input_json["tradeoff"] = ["machines", "raw"]
+    output_json = {
+        "status": "ok",
+        "tradeoff": [
+            {"objective": "machines", "values": {"machines": 0.033333333, "power": 10.0, "footprint": 0.0, "raw": 200.0}},
+            {"objective": "raw", "values": {"machines": 0.183333333, "power": 13.333333333, "footprint": 0.0, "raw": 100.0}}
+        ]
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+    input_json.pop("tradeoff")
+    input_json["objective"] = ["raw", "power"]
+    output_json = {
+        "status": "ok",
+        "per_recipe_crafts_per_min": {"C_fast": 0.0, "C_slow": 100.0, "A_raw": 0.0, "B_raw": 100.0},
+        "per_machine_counts": {"fast_m": 0.016666667, "slow_m": 0.166666667},
+        "raw_consumption_per_min": {"raw_A": 0.0, "raw_B": 100.0},
+        "objective_values": {"machines": 0.183333333, "power": 13.333333333, "footprint": 0.0, "raw": 100.0}
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+def test_factory_module_supply():
+    input_json = copy.deepcopy(TEST_CASES[0].values[0])
+    for modules in input_json["modules"].values():
+        modules["slots"] = 4
+    input_json["module_supply"] = {"prod": 1000, "speed": 1000}
+    output_json = {
+        "status": "ok",
+        "per_recipe_crafts_per_min": {"iron_plate": 1636.363636364, "copper_plate": 4909.090909091, "green_circuit": 1800.0},
+        "per_machine_counts": {"assembler_1": 0.454545455, "chemical": 4.848484848},
+        "raw_consumption_per_min": {"iron_ore": 1363.636363636, "copper_ore": 4090.909090909},
+        "per_recipe_modules": {
+            "iron_plate": {"prod_machines": 1.212121212, "prod_modules": 4.848484848, "speed_machines": 0.0, "speed_modules": 0.0},
+            "copper_plate": {"prod_machines": 3.636363636, "prod_modules": 14.545454545, "speed_machines": 0.0, "speed_modules": 0.0},
+            "green_circuit": {"prod_machines": 0.454545455, "prod_modules": 1.818181818, "speed_machines": 0.0, "speed_modules": 0.0}
+        },
+        "module_usage": {"prod": 21.212121212, "speed": 0.0}
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+    # Without prod modules the copper ore runs out first
+    input_json["module_supply"] = {"prod": 0, "speed": 0}
+    output_json = {
+        "status": "infeasible",
+        "max_feasible_target_per_min": 1666.666666667,
+        "bottleneck_hint": ["prod modules supply", "copper_ore supply"],
+        "bottleneck_gain": ["+1 prod module gives +90/min", "+1/min copper_ore gives +0.333333/min"]
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+def test_factory_targets():
+    input_json = copy.deepcopy(TEST_CASES[0].values[0])
+    input_json.pop("target")
+    input_json["targets"] = {"green_circuit": 1800, "iron_plate": 500}
+    output_json = {
+        "status": "ok",
+        "per_recipe_crafts_per_min": {"iron_plate": 2136.363636364, "copper_plate": 4909.090909091, "green_circuit": 1800.0},
+        "per_machine_counts": {"assembler_1": 0.395256917, "chemical": 4.744413835},
+        "raw_consumption_per_min": {"iron_ore": 1780.303030303, "copper_ore": 4090.909090909}
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+    # copper_plate has the highest rate, so it is the reference target
+    input_json["targets"] = {"green_circuit": 1800, "copper_plate": 5000}
+    output_json = {
+        "status": "infeasible",
+        "max_feasible_target_per_min": 3027.52293578,
+        "bottleneck_hint": ["copper_ore supply"],
+        "bottleneck_gain": ["+1/min copper_ore gives +0.605505/min"],
+        "max_feasible_targets_per_min": {"green_circuit": 1089.908256881, "copper_plate": 3027.52293578}
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+def test_factory_curve():
+    input_json = copy.deepcopy(TEST_CASES[4].values[0])
+    input_json["curve"] = True
+    input_json["limits"]["max_machines"] = {"fast_m": 0.5, "slow_m": 1}
+    output_json = {
+        "status": "ok",
+        "max_feasible_target_per_min": 1600.0,
+        "breakpoints": [
+            {"target_per_min": 0.0, "machines": 0.0},
+            {"target_per_min": 1000.0, "machines": 0.333333333},
+            {"target_per_min": 1600.0, "machines": 1.433333333}
+        ],
+        "segments": [
+            {"from_target_per_min": 0.0, "to_target_per_min": 1000.0, "machines_per_target": 0.000333333, "bottleneck": []},
+            {"from_target_per_min": 1000.0, "to_target_per_min": 1600.0, "machines_per_target": 0.001833333, "bottleneck": ["raw_A supply"]}
+        ],
+        "bottleneck_hint": ["slow_m cap", "raw_A supply"],
+        "bottleneck_gain": ["+1 slow_m gives +600/min", "+1/min raw_A gives +1/min"]
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+def test_factory_curve_unreachable():
+    input_json = copy.deepcopy(TEST_CASES[4].values[0])
+    input_json["curve"] = True
+    input_json["limits"]["max_machines"] = {"fast_m": 0, "slow_m": 0}
+    output_json = {
+        "status": "ok",
+        "max_feasible_target_per_min": 0.0,
+        "breakpoints": [{"target_per_min": 0.0, "machines": 0.0}],
+        "segments": [],
+        "bottleneck_hint": ["fast_m cap"],
+        "bottleneck_gain": ["+1 fast_m gives +6000/min"]
+    }
+    compare_json(run_program("factory/main.py", input_json), output_json)
+
+SESSION_SCRIPT = """
+import copy, json, sys
+sys.path.insert(0, "factory")
+from main import FactorySession, format_floats, solve
+request = json.load(sys.stdin)
+session = FactorySession(copy.deepcopy(request["data"]))
+for method, *args in request["steps"]:
+    if method != "solve":
+        getattr(session, method)(*args)
+    warm_starts = session.warm_starts
+    soln = session.solve()
+    fresh = solve(copy.deepcopy(session.data))
+    path = "warm" if session.warm_starts > warm_starts else "cold"
+    print(json.dumps(format_floats({"session": soln, "fresh": fresh, "path": path})))
+"""
+
+def test_factory_session():
+    # Every what-if answer matches a fresh solve of the edited request
+    steps = [
+        ["solve"],
+        ["set_target_rate", 1200],
+        ["set_supply_limit", "copper_ore", 2000],
+        ["set_supply_limit", "copper_ore", 5000],
+        ["set_machine_limit", "chemical", 2],
+        ["set_machine_limit", "chemical", 300],
+        ["set_target_rate", 600],
+        ["set_modules", "chemical", 0.1, 0.2],
+        ["set_target_rate", 900],
+    ]
+    result = subprocess.run(
+        ["python3", "-c", SESSION_SCRIPT],
+        input=json.dumps({"data": TEST_CASES[0].values[0], "steps": steps}),
+        capture_output=True,
+        text=True,
+    )
+    results = [json.loads(line) for line in result.stdout.splitlines()]
+    assert len(results) == len(steps), result.stderr
+    for step in results:
+        compare_json(step["session"], step["fresh"])
+    # Rate and limit changes reuse the basis, infeasible answers and module changes do not
+    assert [step["path"] for step in results] == ["cold", "warm", "cold", "cold", "cold", "cold", "warm", "cold", "warm"]